@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
-from catalog.direct import provider
+from catalog.direct import provider, CatalogGridStore
 from catalog.models import Link
+from catalog.utils import SlugAllocator, urlify
 from django import template
 from django.contrib import admin
 from django.contrib.admin import helpers
@@ -61,11 +62,34 @@ class CatalogAdmin(admin.ModelAdmin):
         which connected to pre_save() signal of each catalog model 
         """
         FormClass = super(CatalogAdmin, self).get_form(request, obj, **kwargs)
+        slug_source = self.prepopulated_fields.get('slug', (None,))[0]
 
         class ModelFormCatalogWrapper(FormClass):
             '''
             Wrapper around ModelForm class due to redefine save method for ModelForm
             '''
+            def clean(self):
+                '''
+                Make unique slug from prepopulated source field if slug is empty,
+                entered slug which is already taken is an error
+                '''
+                cleaned_data = super(ModelFormCatalogWrapper, self).clean()
+                if 'slug' not in self.fields or 'slug' in self._errors:
+                    return cleaned_data
+                slug = cleaned_data.get('slug')
+                model_cls = self._meta.model
+                if not slug:
+                    if slug_source is not None:
+                        slug = urlify(cleaned_data.get(slug_source) or u'')
+                        allocator = SlugAllocator(model_cls, preload=False)
+                        cleaned_data['slug'] = allocator.allocate(slug, exclude_pk=self.instance.pk)
+                elif model_cls._default_manager.filter(slug=slug).exclude(
+                        pk=self.instance.pk).exists():
+                    self._errors['slug'] = self.error_class(
+                        [_('This slug is already taken')])
+                    del cleaned_data['slug']
+                return cleaned_data
+
             def save(self, *args, **kwds):
                 '''Redefined ModelForm method in order to set parent attribute'''
                 if 'parent' in request.REQUEST:
@@ -199,6 +223,21 @@ class TreeItemAdmin(MPTTModelAdmin):
         return direct_to_template(request, 'admin/catalog/extjs_admin.html',
             extra_context=context)
     
+    def export(self, request):
+        '''
+        Unpaginated grid data for ``parent`` GET parameter,
+        streamed record by record
+        '''
+        if not self.has_change_permission(request, None):
+            raise PermissionDenied
+
+        parent = request.GET.get('parent', 'root')
+        if parent == 'root':
+            parent = None
+        store = CatalogGridStore()
+        return HttpResponse(store.stream(TreeItem.objects.with_content_objects(), parent=parent),
+            mimetype='application/json')
+
     def changelist_view_wrapper(self, request, extra_context=None):
         '''Overrides ``changelist_view`` to enable ``plain`` html view key in GET'''
         if 'plain' in request.GET:
@@ -228,6 +267,8 @@ class TreeItemAdmin(MPTTModelAdmin):
                 name='catalog_provider_router'),
             url(r'^direct/provider.js$', self.admin_site.admin_view(provider.script),
                 name='catalog_provider_script'),
+            url(r'^direct/export/$', self.admin_site.admin_view(self.export),
+                name='catalog_grid_export'),
         ) + super(TreeItemAdmin, self).get_urls()
 
 
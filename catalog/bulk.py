@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+'''
+Bulk tree operations. They work with whole subtrees and renumber
+``lft``/``rght`` once per affected tree instead of once per node.
+'''
+from catalog.models import (TreeItem, bump_tree_version,
+    suspend_tree_sync, resume_tree_sync, published_object_ids)
+from catalog.utils import registry
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import AutoField, Q, Max
+from django.utils.translation import ugettext as _
+from mptt.exceptions import InvalidMove
+
+# SQLite limit of bound parameters in one statement
+MAX_QUERY_PARAMS = 999
+# values in one ``__in`` lookup, other conditions of query need parameters too
+LOOKUP_BATCH_SIZE = 500
+# rows in one ``executemany`` call, parameters are bound per row
+INSERT_BATCH_SIZE = 1000
+
+def _batches(values, size=LOOKUP_BATCH_SIZE):
+    '''Split list to slices of given size'''
+    for start in xrange(0, len(values), size):
+        yield values[start:start + size]
+
+def _outermost(nodes):
+    '''
+    Filter out nodes, which lie inside subtree of other node in list.
+    ``nodes`` is a list of (id, tree_id, lft, rght) tuples
+    '''
+    result = []
+    for node in sorted(nodes, key=lambda node: (node[1], node[2])):
+        if result and result[-1][1] == node[1] and result[-1][3] > node[2]:
+            continue
+        result.append(node)
+    return result
+
+def _subtrees_q(nodes):
+    subtrees_q = Q()
+    for node_id, tree_id, lft, rght in nodes:
+        subtrees_q |= Q(tree_id=tree_id, lft__gte=lft, rght__lte=rght)
+    return subtrees_q
+
+def _shift_sql(column, ranges, params):
+    '''
+    SQL expression with sum of widths of ranges, lying left to column value
+    '''
+    cases = []
+    for lft, rght in ranges:
+        cases.append('CASE WHEN %s > %%s THEN %%s ELSE 0 END' % column)
+        params.extend([rght, rght - lft + 1])
+    return ' + '.join(cases)
+
+def close_gaps(removed):
+    '''
+    Renumber ``lft``/``rght`` after subtrees removal with one UPDATE per tree
+    (per batch of ranges for many ranges).
+    ``removed`` is dictionary {tree_id: [(lft, rght), ...]} of removed ranges.
+    '''
+    qn = connection.ops.quote_name
+    opts = TreeItem._meta
+    cursor = connection.cursor()
+    # four parameters per range, batches go from right to left,
+    # so ranges of next batch are not moved by previous ones
+    batch_size = (MAX_QUERY_PARAMS - 2) // 4
+    for tree_id, ranges in removed.iteritems():
+        for batch in _batches(sorted(ranges, reverse=True), batch_size):
+            params = []
+            lft_shift = _shift_sql(qn('lft'), batch, params)
+            rght_shift = _shift_sql(qn('rght'), batch, params)
+            params.extend([tree_id, min([lft for lft, rght in batch])])
+            cursor.execute('UPDATE %(table)s SET %(lft)s = %(lft)s - (%(lft_shift)s), '
+                '%(rght)s = %(rght)s - (%(rght_shift)s) '
+                'WHERE %(tree_id)s = %%s AND %(rght)s > %%s' % {
+                    'table': qn(opts.db_table),
+                    'lft': qn('lft'),
+                    'rght': qn('rght'),
+                    'tree_id': qn('tree_id'),
+                    'lft_shift': lft_shift,
+                    'rght_shift': rght_shift,
+                }, params)
+
+@transaction.commit_on_success
+def delete_subtrees(ids):
+    '''
+    Delete tree items with given ids, their descendants and content objects.
+    Content objects are deleted with one queryset per content type,
+    tree is renumbered once. Returns number of deleted tree items.
+    '''
+    nodes = []
+    for batch in _batches(list(ids)):
+        nodes.extend(TreeItem.objects.filter(id__in=batch).values_list(
+            'id', 'tree_id', 'lft', 'rght'))
+    nodes = _outermost(nodes)
+    if not nodes:
+        return 0
+    # three parameters per subtree condition
+    subtrees = [TreeItem.objects.filter(_subtrees_q(batch))
+        for batch in _batches(nodes, LOOKUP_BATCH_SIZE // 3)]
+
+    object_ids = {}
+    count = 0
+    for queryset in subtrees:
+        for content_type_id, object_id in queryset.values_list('content_type', 'object_id'):
+            object_ids.setdefault(content_type_id, []).append(object_id)
+            count += 1
+
+    suspend_tree_sync()
+    try:
+        for content_type_id, id_list in object_ids.iteritems():
+            model_cls = ContentType.objects.get_for_id(content_type_id).model_class()
+            for batch in _batches(id_list):
+                model_cls._default_manager.filter(pk__in=batch).delete()
+        # rows of models without generic relation to tree are still here
+        for queryset in subtrees:
+            queryset.delete()
+    finally:
+        resume_tree_sync()
+
+    removed = {}
+    for node_id, tree_id, lft, rght in nodes:
+        removed.setdefault(tree_id, []).append((lft, rght))
+    close_gaps(removed)
+    bump_tree_version()
+    return count
+
+
+class _TreeState(object):
+    '''
+    In-memory copy of several trees structure, used to calculate
+    final positions of moved or inserted nodes
+    '''
+
+    def __init__(self, tree_ids):
+        self.old = {}
+        self.parent = {}
+        self.children = {}
+        self.paths = {}
+        self.roots = []
+        for batch in _batches(sorted(tree_ids)):
+            rows = TreeItem.objects.filter(tree_id__in=batch).order_by(
+                'tree_id', 'lft').values_list('id', 'parent', 'tree_id', 'lft', 'rght', 'level', 'path')
+            for node_id, parent_id, tree_id, lft, rght, level, path in rows:
+                self.old[node_id] = (tree_id, lft, rght, level)
+                self.parent[node_id] = parent_id
+                self.paths[node_id] = path
+                self.children[node_id] = []
+                if parent_id is None:
+                    self.roots.append(node_id)
+                else:
+                    self.children[parent_id].append(node_id)
+
+    def add(self, key, parent_id):
+        '''Add new node as last child of ``parent_id`` or as new root'''
+        self.parent[key] = parent_id
+        self.children[key] = []
+        if parent_id is None:
+            self.roots.append(key)
+        else:
+            self.children[parent_id].append(key)
+
+    def is_inside(self, node_id, subtree_id):
+        while node_id is not None:
+            if node_id == subtree_id:
+                return True
+            node_id = self.parent[node_id]
+        return False
+
+    def move(self, node_id, target_id, position):
+        if target_id is not None and self.is_inside(target_id, node_id):
+            raise InvalidMove(_('A node may not be made a child of itself or any of its descendants.'))
+        # detach
+        parent_id = self.parent[node_id]
+        if parent_id is None:
+            self.roots.remove(node_id)
+        else:
+            self.children[parent_id].remove(node_id)
+        # insert
+        if target_id is None:
+            self.roots.append(node_id)
+            self.parent[node_id] = None
+        elif position in ('first-child', 'last-child'):
+            siblings = self.children[target_id]
+            if position == 'first-child':
+                siblings.insert(0, node_id)
+            else:
+                siblings.append(node_id)
+            self.parent[node_id] = target_id
+        else:
+            new_parent_id = self.parent[target_id]
+            siblings = self.children[new_parent_id]
+            index = siblings.index(target_id)
+            if position == 'right':
+                index += 1
+            siblings.insert(index, node_id)
+            self.parent[node_id] = new_parent_id
+
+    def renumber(self, next_tree_id):
+        '''
+        Returns {node_id: (tree_id, lft, rght, level)} for new structure.
+        Existing roots keep their tree ids, new roots get ids from ``next_tree_id``
+        '''
+        new = {}
+        for root_id in self.roots:
+            if root_id in self.old and self.old[root_id][3] == 0:
+                # node was root before
+                tree_id = self.old[root_id][0]
+            else:
+                tree_id = next_tree_id
+                next_tree_id += 1
+            counter = 1
+            # node is pushed twice: to set lft and, after children, rght
+            stack = [(root_id, 0)]
+            lfts = {}
+            while stack:
+                node_id, level = stack.pop()
+                if node_id in lfts:
+                    new[node_id] = (tree_id, lfts[node_id], counter, level)
+                    counter += 1
+                    continue
+                lfts[node_id] = counter
+                counter += 1
+                stack.append((node_id, level))
+                for child_id in reversed(self.children[node_id]):
+                    stack.append((child_id, level + 1))
+        return new
+
+    def write(self, new, offset):
+        '''
+        Save new positions of existing nodes, one UPDATE per old tree
+        (per batch of runs for many changed runs).
+        ``offset`` must be greater than any new tree id.
+        '''
+        # group changed nodes to continuous runs by old lft, per old tree
+        runs = {}
+        last_key = {}
+        for node_id, old in sorted(self.old.iteritems(), key=lambda item: (item[1][0], item[1][1])):
+            tree_id, lft, rght, level = old
+            new_tree_id, new_lft, new_rght, new_level = new[node_id]
+            key = (new_lft - lft, new_rght - rght, new_level - level, new_tree_id)
+            if key == (0, 0, 0, tree_id):
+                last_key[tree_id] = None
+                continue
+            tree_runs = runs.setdefault(tree_id, [])
+            if last_key.get(tree_id) == key:
+                tree_runs[-1][1] = lft
+            else:
+                tree_runs.append([lft, lft] + list(key))
+            last_key[tree_id] = key
+
+        cursor = connection.cursor()
+        # 14 parameters per run, updated rows are hidden from next batches by offset
+        batch_size = (MAX_QUERY_PARAMS - 1) // 14
+        for tree_id, tree_runs in runs.iteritems():
+            for batch in _batches(tree_runs, batch_size):
+                sql, params = _renumber_sql(tree_id, batch, offset)
+                cursor.execute(sql, params)
+        qn = connection.ops.quote_name
+        cursor.execute('UPDATE %(table)s SET %(tree_id)s = %(tree_id)s - %%s WHERE %(tree_id)s >= %%s' % {
+            'table': qn(TreeItem._meta.db_table),
+            'tree_id': qn('tree_id'),
+        }, [offset, offset])
+
+    def subtree(self, node_id):
+        nodes = [node_id]
+        for node_id in nodes:
+            nodes.extend(self.children[node_id])
+        return nodes
+
+    def path(self, node_id):
+        ancestors = []
+        parent_id = self.parent[node_id]
+        while parent_id is not None:
+            ancestors.append(parent_id)
+            parent_id = self.parent[parent_id]
+        ancestors.reverse()
+        return ''.join(['%s/' % ancestor_id for ancestor_id in ancestors])
+
+
+def _renumber_sql(tree_id, runs, offset):
+    '''
+    One UPDATE for all changed runs of nodes in old tree. Runs are tuples
+    (first lft, last lft, lft delta, rght delta, level delta, new tree_id).
+    New tree_id is stored with ``offset`` to hide updated rows from next statements.
+    Columns are listed so, that ``lft``, used in conditions, is assigned last.
+    '''
+    qn = connection.ops.quote_name
+    params = []
+
+    def case(index, default):
+        whens = []
+        for run in runs:
+            whens.append('WHEN %s BETWEEN %%s AND %%s THEN %%s' % qn('lft'))
+            value = run[index]
+            if index == 5:
+                value += offset
+            params.extend([run[0], run[1], value])
+        return 'CASE %s ELSE %s END' % (' '.join(whens), default)
+
+    assignments = [
+        '%s = %s + (%s)' % (qn('level'), qn('level'), case(4, '0')),
+        '%s = %s + (%s)' % (qn('rght'), qn('rght'), case(3, '0')),
+        '%s = %s' % (qn('tree_id'), case(5, qn('tree_id'))),
+        '%s = %s + (%s)' % (qn('lft'), qn('lft'), case(2, '0')),
+    ]
+    params.append(tree_id)
+    where = ['%s BETWEEN %%s AND %%s' % qn('lft')] * len(runs)
+    for run in runs:
+        params.extend([run[0], run[1]])
+    sql = 'UPDATE %s SET %s WHERE %s = %%s AND (%s)' % (
+        qn(TreeItem._meta.db_table), ', '.join(assignments),
+        qn('tree_id'), ' OR '.join(where))
+    return sql, params
+
+@transaction.commit_on_success
+def move_subtrees(source_ids, target_id, position='last-child'):
+    '''
+    Move several nodes with their subtrees to ``target_id`` node
+    (or make them root nodes if ``target_id`` is None), one by one like
+    ``TreeItem.move_to`` does, but renumber tree once.
+    ``position`` is one of ``'first-child'``, ``'last-child'``, ``'left'``, ``'right'``.
+    '''
+    source_ids = [int(node_id) for node_id in source_ids
+        if target_id is None or int(node_id) != int(target_id)]
+    if not source_ids:
+        return
+    if target_id is not None:
+        target = TreeItem.objects.get(id=target_id)
+        if position in ('left', 'right') and target.parent_id is None:
+            # siblings of root nodes require tree ids shift, let mptt do it
+            for node_id in source_ids:
+                TreeItem.objects.get(id=node_id).move_to(
+                    TreeItem.objects.get(id=target_id), position)
+            return
+        tree_ids = set([target.tree_id])
+    else:
+        tree_ids = set()
+    for batch in _batches(source_ids):
+        tree_ids.update(TreeItem.objects.filter(id__in=batch).values_list('tree_id', flat=True))
+
+    state = _TreeState(tree_ids)
+    for node_id in source_ids:
+        state.move(node_id, target_id is not None and int(target_id) or None, position)
+
+    max_tree_id = TreeItem.objects.aggregate(Max('tree_id'))['tree_id__max']
+    new = state.renumber(max_tree_id + 1)
+    state.write(new, max_tree_id + len(state.roots) + 1)
+
+    # parent links and stored paths of moved subtrees
+    by_parent = {}
+    for node_id in source_ids:
+        by_parent.setdefault(state.parent[node_id], []).append(node_id)
+    for parent_id, node_ids in by_parent.iteritems():
+        for batch in _batches(node_ids):
+            TreeItem.objects.filter(id__in=batch).update(parent=parent_id)
+    by_path = {}
+    for source_id in source_ids:
+        for node_id in state.subtree(source_id):
+            # not calculated paths are left for rebuild_paths
+            if state.paths[node_id] is not None:
+                by_path.setdefault(state.path(node_id), set()).add(node_id)
+    for path, node_ids in by_path.iteritems():
+        for batch in _batches(list(node_ids)):
+            TreeItem.objects.filter(id__in=batch).update(path=path)
+    bump_tree_version()
+
+
+def _insert_rows(rows):
+    opts = TreeItem._meta
+    qn = connection.ops.quote_name
+    columns = [opts.get_field(name).column for name in ('parent', 'content_type',
+        'object_id', 'is_published', 'path', 'tree_id', 'lft', 'rght', 'level')]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(opts.db_table),
+        ', '.join([qn(column) for column in columns]), ', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+    for batch in _batches(rows, INSERT_BATCH_SIZE):
+        cursor.executemany(sql, batch)
+
+def insert_objects(model_cls, objects, key='slug'):
+    '''
+    Insert new model instances with ``executemany``, no signals are sent.
+    Primary keys are set afterwards by lookup of unique ``key`` field values,
+    pass ``key=None`` if they are not needed.
+    '''
+    if not objects:
+        return
+    opts = model_cls._meta
+    qn = connection.ops.quote_name
+    fields = [field for field in opts.local_fields if not isinstance(field, AutoField)]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(opts.db_table),
+        ', '.join([qn(field.column) for field in fields]), ', '.join(['%s'] * len(fields)))
+    rows = [[field.get_db_prep_save(field.pre_save(obj, True), connection=connection)
+        for field in fields] for obj in objects]
+    cursor = connection.cursor()
+    for batch in _batches(rows, INSERT_BATCH_SIZE):
+        cursor.executemany(sql, batch)
+    if key is None:
+        return
+
+    by_key = dict([(getattr(obj, key), obj) for obj in objects])
+    values = by_key.keys()
+    for batch in _batches(values):
+        inserted = model_cls._default_manager.filter(**{
+            '%s__in' % key: batch}).values_list(key, 'pk')
+        for value, pk in inserted:
+            by_key[value].pk = pk
+
+def update_objects(model_cls, objects, field_names):
+    '''
+    Save given fields of many objects with one ``UPDATE`` per batch,
+    values are selected by primary key with ``CASE``. No signals are sent.
+    '''
+    opts = model_cls._meta
+    qn = connection.ops.quote_name
+    fields = [opts.get_field(name) for name in field_names]
+    pk_column = qn(opts.pk.column)
+    cursor = connection.cursor()
+    # pk and value for every field, pk for ``IN``
+    batch_size = MAX_QUERY_PARAMS // (2 * len(fields) + 1)
+    for batch in _batches(objects, batch_size):
+        assignments, params = [], []
+        for field in fields:
+            cases = []
+            for obj in batch:
+                cases.append('WHEN %s THEN %s')
+                params.extend([obj.pk, field.get_db_prep_save(
+                    getattr(obj, field.attname), connection=connection)])
+            # ELSE branch gives column type to CASE expression
+            assignments.append('%s = CASE %s %s ELSE %s END' % (qn(field.column),
+                pk_column, ' '.join(cases), qn(field.column)))
+        params.extend([obj.pk for obj in batch])
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (qn(opts.db_table),
+            ', '.join(assignments), pk_column, ', '.join(['%s'] * len(batch))), params)
+
+def insert_nodes(nodes):
+    '''
+    Insert many tree items at once, renumbering every affected tree once.
+    ``nodes`` is a list of ``(key, parent, content_type_id, object_id)`` tuples.
+    ``parent`` is existing TreeItem id, None for new root or a key of
+    new node listed before. Keys must not be integers. Nodes are appended
+    as last children. Returns dictionary {key: TreeItem id}.
+    '''
+    if not nodes:
+        return {}
+    existing_parents = list(set([node[1] for node in nodes if isinstance(node[1], (int, long))]))
+    tree_ids = set()
+    for batch in _batches(existing_parents):
+        tree_ids.update(TreeItem.objects.filter(id__in=batch).values_list('tree_id', flat=True))
+    state = _TreeState(tree_ids)
+    for key, parent, content_type_id, object_id in nodes:
+        state.add(key, parent)
+
+    max_tree_id = TreeItem.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0
+    new = state.renumber(max_tree_id + 1)
+    state.write(new, max_tree_id + len(state.roots) + 1)
+
+    published = {}
+    object_ids = {}
+    for key, parent, content_type_id, object_id in nodes:
+        object_ids.setdefault(content_type_id, []).append(object_id)
+    for content_type_id, id_list in object_ids.iteritems():
+        model_cls = registry.content_type_ids.get(content_type_id)
+        published[content_type_id] = set()
+        for batch in _batches(id_list):
+            published[content_type_id].update(published_object_ids(model_cls, batch))
+
+    # insert by generations, children need ids of inserted parents
+    ids = {}
+    paths = {}
+    pending = nodes
+    while pending:
+        ready, waiting = [], []
+        for node in pending:
+            parent = node[1]
+            if parent is None or parent in state.old or parent in ids:
+                ready.append(node)
+            else:
+                waiting.append(node)
+        if not ready:
+            raise ValueError('Unknown parents: %s' % ', '.join(
+                [repr(node[1]) for node in waiting]))
+
+        rows = []
+        for key, parent, content_type_id, object_id in ready:
+            if parent is None:
+                parent_id, path = None, ''
+            elif parent in state.old:
+                # like TreeItem.save, path is set even if parent path is not calculated
+                parent_id, path = parent, state.path(parent)
+            else:
+                parent_id, path = ids[parent], paths[parent]
+            if parent_id is not None:
+                path = '%s%s/' % (path, parent_id)
+            paths[key] = path
+            tree_id, lft, rght, level = new[key]
+            rows.append((parent_id, content_type_id, object_id,
+                object_id in published[content_type_id], path, tree_id, lft, rght, level))
+        _insert_rows(rows)
+
+        positions = {}
+        for key, parent, content_type_id, object_id in ready:
+            tree_id, lft, rght, level = new[key]
+            positions.setdefault(tree_id, {})[lft] = key
+        for tree_id, keys in positions.iteritems():
+            for batch in _batches(keys.keys()):
+                inserted = TreeItem.objects.filter(tree_id=tree_id,
+                    lft__in=batch).values_list('lft', 'id')
+                for lft, node_id in inserted:
+                    ids[keys[lft]] = node_id
+        pending = waiting
+    bump_tree_version()
+    return ids
+
+def refresh_published(model_cls, object_ids):
+    '''
+    Recalculate ``is_published`` flag of tree items for given objects,
+    changed while tree sync signals were suspended
+    '''
+    if not object_ids:
+        return
+    content_type = ContentType.objects.get_for_model(model_cls)
+    for id_list in _batches(object_ids):
+        published = published_object_ids(model_cls, id_list)
+        unpublished = [object_id for object_id in id_list if object_id not in published]
+        queryset = TreeItem.objects.filter(content_type=content_type)
+        if published:
+            queryset.filter(object_id__in=list(published)).update(is_published=True)
+        if unpublished:
+            queryset.filter(object_id__in=unpublished).update(is_published=False)
+    bump_tree_version()
+
+def check_tree(tree_id):
+    '''
+    Returns True if nested set numbers of tree are consistent:
+    ``lft`` and ``rght`` values fill range 1..2N without gaps,
+    every node lies inside its parent
+    '''
+    rows = TreeItem.objects.filter(tree_id=tree_id).values_list('id', 'parent', 'lft', 'rght', 'level')
+    nodes = dict([(node_id, (parent_id, lft, rght, level))
+        for node_id, parent_id, lft, rght, level in rows])
+    numbers = []
+    for node_id, (parent_id, lft, rght, level) in nodes.iteritems():
+        if rght <= lft:
+            return False
+        numbers.extend([lft, rght])
+        if parent_id is None:
+            if level != 0:
+                return False
+        else:
+            if parent_id not in nodes:
+                return False
+            parent_lft, parent_rght, parent_level = nodes[parent_id][1:]
+            if not (parent_lft < lft and rght < parent_rght and level == parent_level + 1):
+                return False
+    return sorted(numbers) == range(1, 2 * len(nodes) + 1)
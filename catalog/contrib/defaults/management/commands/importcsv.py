@@ -1,32 +1,74 @@
 # -*- coding: utf-8 -*-
+from catalog.bulk import (insert_objects, insert_nodes, update_objects,
+    check_tree, refresh_published)
 from catalog.contrib.defaults.models import Section, Item
-from catalog.models import TreeItem
+from catalog.models import TreeItem, suspend_tree_sync, resume_tree_sync
+from catalog.utils import SlugAllocator, urlify
 from decimal import Decimal
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-from django.db.utils import IntegrityError
+from multiprocessing import Process, Queue
 from optparse import make_option
+from Queue import Empty
+from threading import Thread
 from time import time
 import csv
 import logging
 import mptt
+import os
 
-try:
-    from pinyin.urlify import urlify
-except ImportError:
-    try:
-        from pytils.translit import slugify as urlify
-    except ImportError:
-        from django.template.defaultfilters import slugify as urlify
+# rows in one task of parse worker process
+PARSE_CHUNK_SIZE = 500
+# seconds to wait for parsed chunk before checking worker processes
+PARSE_RESULT_TIMEOUT = 5
+
+def parse_worker(tasks, results):
+    '''
+    Parse worker process: converts chunks of csv rows to
+    (offset, item options, section options) tuples. Stops on None task.
+    '''
+    command = Command()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, rows = task
+        parsed, error = [], None
+        for offset, line_num, param_list in rows:
+            try:
+                parsed.append((offset, command.kwargs_from_list(param_list, Item),
+                    command.kwargs_from_list(param_list, Section)))
+            except Exception, e:
+                # any error is reported to importing process, not lost in worker
+                error = 'Line %d: %r' % (line_num, e)
+                break
+        results.put((index, parsed, error))
 
 
 class Command(BaseCommand):
     help = '''Import items from CSV format
     Usage: manage.py importcsv wares.txt
     '''
+    # item fields, which are updated from csv file
+    update_fields = ('article', 'name', 'price')
+
     option_list = BaseCommand.option_list + (
         make_option('--verbose', default=0, dest='verbose', type='int',
             help='Verbose level 0, 1 or 2 (0 by default)'),
+        make_option('--bulk', default=False, dest='bulk', action='store_true',
+            help='Insert new sections and items in batches, without per-row signals'),
+        make_option('--batch-size', default=5000, dest='batch_size', type='int',
+            help='Rows per insert or update batch (5000 by default)'),
+        make_option('--commit-every', default=0, dest='commit_every', type='int',
+            help='Commit after every N rows, 0 means one transaction for whole file'),
+        make_option('--checkpoint', default=None, dest='checkpoint',
+            help='Checkpoint file, <file>.checkpoint by default'),
+        make_option('--resume', default=False, dest='resume', action='store_true',
+            help='Continue import from position, saved in checkpoint file'),
+        make_option('--workers', default=0, dest='workers', type='int',
+            help='Number of processes, which parse rows for database writer, '
+                '0 means parsing in the same process'),
     )
     
     def kwargs_from_list(self, list, klass):
@@ -67,17 +109,155 @@ class Command(BaseCommand):
             quoting = csv.QUOTE_MINIMAL
             
         # Preparing
-        reader = csv.reader(open(filename, 'r'), dialect=csv_format)
+        self.checkpoint = self.options['checkpoint'] or '%s.checkpoint' % filename
+        self.offset, self.rows_done = 0, 0
+        if self.options['resume']:
+            if os.path.exists(self.checkpoint):
+                self.offset, self.rows_done = self.read_checkpoint()
+                logging.info('Resuming from row %d' % self.rows_done)
+            else:
+                logging.warning('No checkpoint %s, starting from the beginning' % self.checkpoint)
+        f = open(filename, 'rb')
+        f.seek(self.offset)
+        reader = csv.reader(self.read_lines(f), dialect=csv_format)
+        if self.options['workers']:
+            rows = self.parse_rows_parallel(reader)
+        else:
+            rows = self.parse_rows(reader)
 
         logging.info('Loading objects')
         self.load_objects()
+        self.changed_items = {}
+        self.stats = {'created': 0, 'updated': 0, 'unchanged': 0}
 
         # Run!
         logging.info('Importing items')
-        count = self.make_items(reader)
+        if self.options['bulk']:
+            count = self.make_items_bulk(rows)
+        else:
+            count = self.make_items(rows)
+
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
 
         work_time = time() - start_time
         logging.debug('%s items imported in %s s' % (count, work_time))
+        logging.info('%(created)d created, %(updated)d updated, %(unchanged)d unchanged' % self.stats)
+
+    def read_lines(self, f):
+        '''
+        Yields file lines and remembers offset after last line read.
+        ``f.tell()`` is not available while iterating over file.
+        '''
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            self.read_offset = f.tell()
+            yield line
+
+    def parse_rows(self, reader):
+        '''Yields (item options, section options) for every row'''
+        for param_list in reader:
+            self.offset = self.read_offset
+            yield self.kwargs_from_list(param_list, Item), self.kwargs_from_list(param_list, Section)
+
+    def parse_rows_parallel(self, reader):
+        '''
+        Same as :meth:`parse_rows`, but rows are parsed by worker processes.
+        Chunks are read by feeder thread, both queues are bounded,
+        parsed chunks are yielded in file order.
+        '''
+        workers = self.options['workers']
+        tasks = Queue(workers * 2)
+        results = Queue(workers * 2)
+        processes = [Process(target=parse_worker, args=(tasks, results))
+            for i in xrange(workers)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        def feed():
+            index, chunk, error = 0, [], None
+            try:
+                for param_list in reader:
+                    chunk.append((self.read_offset, reader.line_num, param_list))
+                    if len(chunk) == PARSE_CHUNK_SIZE:
+                        tasks.put((index, chunk))
+                        index, chunk = index + 1, []
+                if chunk:
+                    tasks.put((index, chunk))
+                    index += 1
+            except csv.Error, e:
+                error = 'Line %d: %s' % (reader.line_num, e)
+            except Exception, e:
+                error = 'Line %d: %r' % (reader.line_num, e)
+            # (None, number of chunks, error) marks end of file
+            results.put((None, index, error))
+            for process in processes:
+                tasks.put(None)
+
+        feeder = Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        try:
+            ready = {}
+            next_index, total, read_error = 0, None, None
+            while total is None or next_index < total:
+                try:
+                    index, parsed, error = results.get(timeout=PARSE_RESULT_TIMEOUT)
+                except Empty:
+                    for process in processes:
+                        if process.exitcode:
+                            raise CommandError('Parse worker exited with code %d' % process.exitcode)
+                    # finished workers have sent all their chunks
+                    if not feeder.is_alive() and not [process for process in processes
+                            if process.is_alive()]:
+                        raise CommandError('Parse workers stopped before end of file')
+                    continue
+                if index is None:
+                    total, read_error = parsed, error
+                    continue
+                ready[index] = (parsed, error)
+                while next_index in ready:
+                    parsed, error = ready.pop(next_index)
+                    next_index += 1
+                    for offset, item_options, section_options in parsed:
+                        self.offset = offset
+                        yield item_options, section_options
+                    if error:
+                        raise CommandError(error)
+            if read_error:
+                raise CommandError(read_error)
+        finally:
+            # do not wait for queued data on exit after failure
+            tasks.cancel_join_thread()
+            results.cancel_join_thread()
+            for process in processes:
+                process.terminate()
+
+    def read_checkpoint(self):
+        '''Returns (byte offset, row count) of last commit'''
+        offset, rows = open(self.checkpoint).read().split()
+        return int(offset), int(rows)
+
+    def write_checkpoint(self, count):
+        tmp_name = '%s.tmp' % self.checkpoint
+        f = open(tmp_name, 'w')
+        f.write('%d %d\n' % (self.offset, self.rows_done + count))
+        f.close()
+        os.rename(tmp_name, self.checkpoint)
+
+    def commit(self, count):
+        '''
+        Commit imported rows, with chunked commits save position
+        to continue with ``--resume`` after failure
+        '''
+        self.flush_updates()
+        transaction.commit()
+        if self.options['commit_every']:
+            self.write_checkpoint(count)
+        logging.info('%d rows committed' % (self.rows_done + count))
 
     def load_objects(self):
         '''Creates in-memory object cache'''
@@ -111,6 +291,10 @@ class Command(BaseCommand):
         self.cache = {}
         self.cache['section_by_name'] = load_from_queryset(Section.objects.all(), 'name')
         self.cache['item_by_article'] = load_from_queryset(Item.objects.all(), 'article')
+        self.slugs = {
+            Section: SlugAllocator(Section),
+            Item: SlugAllocator(Item),
+        }
 
     def _get_or_create_section(self, options, parent):
         name = options['name']
@@ -118,6 +302,8 @@ class Command(BaseCommand):
             return self.cache['section_by_name'][name].tree.get()
         else:
             section = Section(**options)
+            if 'slug' in options:
+                section.slug = self.slugs[Section].allocate(section.slug)
             section.parent=parent 
             section.save()
     
@@ -126,50 +312,185 @@ class Command(BaseCommand):
             logging.debug('[S] === %s ===' % section)
             return section.tree.get()
 
+    def update_item(self, item, options):
+        '''
+        Compare imported values with preloaded item and remember
+        changed item for batched update. Slug is never changed.
+        '''
+        changed = False
+        for key in self.update_fields:
+            if getattr(item, key) != options[key]:
+                setattr(item, key, options[key])
+                changed = True
+        if not changed:
+            self.stats['unchanged'] += 1
+            return
+        if item.id not in self.changed_items:
+            self.stats['updated'] += 1
+        self.changed_items[item.id] = item
+        logging.debug('[U] %s' % options['name'])
+        if len(self.changed_items) >= self.options['batch_size']:
+            self.flush_updates()
+
+    def flush_updates(self):
+        '''
+        Save changed items with one UPDATE per batch. Signals are not sent,
+        so published flags are refreshed here.
+        '''
+        items = self.changed_items.values()
+        update_objects(Item, items, self.update_fields)
+        refresh_published(Item, [item.id for item in items])
+        self.changed_items = {}
+
     def _update_or_create_item(self, options, parent):
         
         if options['article'] in self.cache['item_by_article']:
             item = self.cache['item_by_article'][options['article']]
-            # TODO: update item
-            for key, value in options.iteritems():
-                setattr(item, key, value)
-            item.save()
- 
-            self.cache['item_by_article'].update({item.article: item})
-            logging.debug('[U] %s' % options['name'])
+            self.update_item(item, options)
             # True if created
             return False
         else:
             item = Item(**options)
             item.parent = parent
-            try:
-                item.save()
-            except IntegrityError:
-                from random import randint
-                item.slug = item.slug + '%d' % randint(0,9)
-                item.save()
+            item.slug = self.slugs[Item].allocate(item.slug)
+            item.save()
 
             self.cache['item_by_article'].update({item.article: item})
+            self.stats['created'] += 1
             logging.debug('[S] %s' % item.name)
             # True if created
             return True
 
-    @transaction.commit_on_success
-    def make_items(self, reader):
-        # before import
+    @transaction.commit_manually
+    def make_items(self, rows):
+        commit_every = self.options['commit_every']
+        try:
+            # before import
+            try:
+                import_section = Section.objects.get(name=u'Импорт')
+                self.parent_import_section = import_section.tree.get()
+            except Section.DoesNotExist:
+                self.parent_import_section = self._get_or_create_section(
+                    {'name':u'Импорт'}, None)
+            # run!
+            count = 0
+            for item_options, section_options in rows:
+                self.make_item_from_options(item_options, section_options)
+                count = count + 1
+                if commit_every and count % commit_every == 0:
+                    self.commit(count)
+            self.commit(count)
+        except:
+            transaction.rollback()
+            raise
+        return count
+
+    @transaction.commit_manually
+    def make_items_bulk(self, rows):
+        '''
+        Import with new sections and items collected in memory and inserted
+        by batches: objects with ``executemany``, tree items with
+        precalculated ``lft``/``rght`` values, one renumber per batch
+        '''
+        try:
+            return self._make_items_bulk(rows)
+        except:
+            transaction.rollback()
+            raise
+
+    def _make_items_bulk(self, rows):
+        commit_every = self.options['commit_every']
         try:
             import_section = Section.objects.get(name=u'Импорт')
             self.parent_import_section = import_section.tree.get()
         except Section.DoesNotExist:
             self.parent_import_section = self._get_or_create_section(
                 {'name':u'Импорт'}, None)
-        # run!
+
+        self.section_ct = ContentType.objects.get_for_model(Section)
+        self.item_ct = ContentType.objects.get_for_model(Item)
+        # section id: tree item id
+        self.cache['section_tree'] = dict(TreeItem.objects.filter(
+            content_type=self.section_ct).values_list('object_id', 'id'))
+        self.new_sections = {}
+        self.new_items = {}
+
         count = 0
-        for item in reader:
-            self.make_item(item)
-            count = count + 1
+        suspend_tree_sync()
+        try:
+            for item_options, section_options in rows:
+                self.collect_item(item_options, section_options)
+                count = count + 1
+                if commit_every and count % commit_every == 0:
+                    self.commit_bulk(count)
+                elif len(self.new_items) >= self.options['batch_size']:
+                    self.flush()
+            self.commit_bulk(count)
+        finally:
+            resume_tree_sync()
         return count
 
+    def commit_bulk(self, count):
+        '''Insert rest of collected objects, check tree and commit'''
+        self.flush()
+        tree_id = TreeItem.objects.filter(id=self.parent_import_section.id
+            ).values_list('tree_id', flat=True)[0]
+        if not check_tree(tree_id):
+            raise CommandError('Tree %s is broken after import, uncommitted changes are rolled back' % tree_id)
+        self.commit(count)
+
+    def collect_item(self, item_options, section_options):
+        '''Update existing item or remember new objects for next batch'''
+        name = section_options['name']
+        if name not in self.cache['section_by_name'] and name not in self.new_sections:
+            section_options['slug'] = self.slugs[Section].allocate(section_options['slug'])
+            self.new_sections[name] = Section(**section_options)
+            logging.debug('[S] === %s ===' % name)
+
+        article = item_options['article']
+        if article in self.cache['item_by_article']:
+            self.update_item(self.cache['item_by_article'][article], item_options)
+        elif article in self.new_items:
+            item, section_name = self.new_items[article]
+            for key, value in item_options.iteritems():
+                if key != 'slug':
+                    setattr(item, key, value)
+            self.new_items[article] = (item, name)
+        else:
+            item_options['slug'] = self.slugs[Item].allocate(item_options['slug'])
+            self.new_items[article] = (Item(**item_options), name)
+            self.stats['created'] += 1
+            logging.debug('[S] %s' % item_options['name'])
+
+    def flush(self):
+        '''Insert collected sections and items with their tree items'''
+        sections = self.new_sections.values()
+        items = self.new_items.values()
+        insert_objects(Section, sections)
+        insert_objects(Item, [item for item, section_name in items])
+
+        nodes = []
+        for section in sections:
+            nodes.append((('section', section.name), self.parent_import_section.id,
+                self.section_ct.id, section.id))
+        for item, section_name in items:
+            if section_name in self.new_sections:
+                parent = ('section', section_name)
+            else:
+                section = self.cache['section_by_name'][section_name]
+                parent = self.cache['section_tree'][section.id]
+            nodes.append((('item', item.article), parent, self.item_ct.id, item.id))
+        ids = insert_nodes(nodes)
+
+        for section in sections:
+            self.cache['section_by_name'][section.name] = section
+            self.cache['section_tree'][section.id] = ids[('section', section.name)]
+        for item, section_name in items:
+            self.cache['item_by_article'][item.article] = item
+        logging.info('%d sections and %d items inserted' % (len(sections), len(items)))
+        self.new_sections = {}
+        self.new_items = {}
+
     def make_item(self, param_list):
         '''
         Makes a new item in catalog
@@ -177,6 +498,8 @@ class Command(BaseCommand):
         '''
         item_options = self.kwargs_from_list(param_list, Item)
         section_options =  self.kwargs_from_list(param_list, Section)
-        
+        return self.make_item_from_options(item_options, section_options)
+
+    def make_item_from_options(self, item_options, section_options):
         import_section = self._get_or_create_section(section_options, self.parent_import_section)
         return self._update_or_create_item(item_options, import_section)
@@ -1,26 +1,55 @@
 # -*- coding: utf-8 -*-
+from Queue import Queue
+from catalog.bulk import insert_objects
 from catalog.models import TreeItem
 from catalog.contrib.defaults.models import Item, CatalogImage
 from django.contrib.contenttypes.models import ContentType
+from django.core.files import File
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from django.forms.models import ModelForm
+from django.utils import simplejson
 from optparse import make_option
+from threading import Thread
+import hashlib
 import logging
 from time import time
 import os
 import re
 
+# CatalogImage rows inserted at once
+IMAGE_BATCH_SIZE = 500
+MANIFEST_NAME = '.importmedia.json'
+
+def file_hash(path):
+    '''SHA-1 hex digest of file, read by chunks'''
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
 
 class Command(BaseCommand):
     help = '''
     Import images and descriptions from given directory recursive
     '''
+    regexp = re.compile('^(\d{1,13})(.*)\.(jpg|bmp|png|gif)')
+
     option_list = BaseCommand.option_list + (
         make_option('--verbose', default=None, dest='verbose', type='int',
             help='Verbose level 0, 1 or 2 (0 by default)'),
         make_option('--rewrite-images', default=None, dest='rewrite', type='string',
             help='Should I delete old images, when find new one for instance?'),
+        make_option('--workers', default=0, dest='workers', type='int',
+            help='Number of threads, which copy files to storage, '
+                '0 means old one-by-one import through model form'),
+        make_option('--manifest', default=None, dest='manifest',
+            help='File with imported images list, %s in directory by default' % MANIFEST_NAME),
     )
 
     def get_model_form_class(self, model_class):
@@ -43,8 +72,16 @@ class Command(BaseCommand):
         if len(args) == 0:
             raise CommandError("You should specify directory to import")
         self.path = args[0]
+        self.manifest_name = self.options['manifest'] or os.path.join(self.path, MANIFEST_NAME)
+        self.manifest = self.load_manifest()
+        self.content_type = ContentType.objects.get_for_model(Item)
 
-        self.import_images()
+        found = self.plan_import()
+        if self.options['workers']:
+            self.import_images_parallel(found)
+        else:
+            self.import_images(found)
+        self.save_manifest()
 
         work_time = time() - start_time
         logging.info('media updated in %s s' % work_time)
@@ -56,25 +93,19 @@ class Command(BaseCommand):
         f.close()
         return upload
 
-    def import_images(self):
+    def import_images(self, found):
         logging.info('=== Importing images ===')
-        self.regexp = re.compile('^(\d{1,13})(.*)\.(jpg|bmp|png|gif)')
         
-        for root, dirs, files in os.walk(self.path):
-            for filename in files:
-                match = self.regexp.match(filename)
-                if match is not None:
-                    uploaded_file = self.prepare_upload(
-                        os.path.join(root, filename), match.groups())
-                    self.upload_image(match.groups(), uploaded_file)
+        for name, path, groups, stat, item_id in found:
+            uploaded_file = self.prepare_upload(path, groups)
+            image = self.upload_image(groups, uploaded_file)
+            if image is not None:
+                self.manifest[name] = list(stat) + [file_hash(path), image.id]
     
     def upload_image(self, groups, uploaded_file):
         try:
             instance = Item.objects.get(article=groups[0])
 
-            if self.options['rewrite']:
-                instance.images.all().delete()
-
             logging.debug('going to update %s with %s ' % (instance, uploaded_file))
 
             FormClass = self.get_model_form_class(CatalogImage)
@@ -91,8 +122,189 @@ class Command(BaseCommand):
             form = FormClass(post_data, file_data)
 
             if form.is_valid():
-                image = form.save()
+                return form.save()
         except Item.DoesNotExist:
             pass
         except Exception, e:
             logging.debug('error: %s', e)
+
+    def find_images(self):
+        '''Returns list of (path, (barcode, suffix, extension)) for matching files'''
+        found = []
+        for root, dirs, files in os.walk(self.path):
+            for filename in files:
+                match = self.regexp.match(filename)
+                if match is not None:
+                    found.append((os.path.join(root, filename), match.groups()))
+        return found
+
+    def store_image(self, path, groups):
+        '''
+        Copy file to storage of image field, returns stored name.
+        Storage reads file by chunks, not at once.
+        '''
+        field = CatalogImage._meta.get_field('image')
+        barcode, suffix, extension = groups
+        name = field.generate_filename(None, '%s%s.%s' % (barcode, suffix, extension))
+        f = open(path, 'rb')
+        try:
+            return field.storage.save(name, File(f))
+        finally:
+            f.close()
+
+    def load_manifest(self):
+        '''
+        Returns dictionary {path relative to directory:
+        [size, mtime, sha1, CatalogImage id]} of previous imports
+        '''
+        if not os.path.exists(self.manifest_name):
+            return {}
+        f = open(self.manifest_name)
+        try:
+            return simplejson.load(f)
+        finally:
+            f.close()
+
+    def save_manifest(self):
+        tmp_name = '%s.tmp' % self.manifest_name
+        f = open(tmp_name, 'w')
+        try:
+            simplejson.dump(self.manifest, f)
+        finally:
+            f.close()
+        os.rename(tmp_name, self.manifest_name)
+
+    def plan_import(self):
+        '''
+        Compare files with manifest. Files with the same size and mtime or,
+        after that, with the same content are skipped. Images of modified
+        files are deleted. Returns list of
+        (name, path, groups, (size, mtime), item id) for upload.
+        '''
+        item_ids = dict(Item.objects.exclude(article=None).values_list('article', 'id'))
+        image_ids = [entry[3] for entry in self.manifest.itervalues()]
+        existing_ids = set()
+        for start in xrange(0, len(image_ids), IMAGE_BATCH_SIZE):
+            existing_ids.update(CatalogImage.objects.filter(
+                id__in=image_ids[start:start + IMAGE_BATCH_SIZE]).values_list('id', flat=True))
+
+        found, modified_ids, keep_ids = [], [], set()
+        seen = set()
+        stats = {'new': 0, 'modified': 0, 'unchanged': 0, 'missing': 0}
+        for path, groups in self.find_images():
+            if groups[0] not in item_ids:
+                logging.debug('no item with article %s' % groups[0])
+                continue
+            name = os.path.relpath(path, self.path)
+            seen.add(name)
+            stat = os.stat(path)
+            stat = (stat.st_size, int(stat.st_mtime))
+            entry = self.manifest.get(name)
+            if entry is not None and entry[3] in existing_ids:
+                if tuple(entry[:2]) == stat or entry[2] == file_hash(path):
+                    entry[:2] = stat
+                    keep_ids.add(entry[3])
+                    stats['unchanged'] += 1
+                    continue
+                modified_ids.append(entry[3])
+                stats['modified'] += 1
+                logging.debug('[M] %s' % name)
+            else:
+                stats['new'] += 1
+                logging.debug('[N] %s' % name)
+            found.append((name, path, groups, stat, item_ids[groups[0]]))
+
+        # entries of removed files are not saved in manifest again
+        for name in self.manifest.keys():
+            if name not in seen and not os.path.exists(os.path.join(self.path, name)):
+                del self.manifest[name]
+                stats['missing'] += 1
+                logging.debug('[D] %s' % name)
+
+        if self.options['rewrite']:
+            # old images of items, which get new files, except unchanged ones
+            item_ids = list(set([item_id for name, path, groups, stat, item_id in found]))
+            for start in xrange(0, len(item_ids), IMAGE_BATCH_SIZE):
+                modified_ids.extend([image_id for image_id in CatalogImage.objects.filter(
+                    content_type=self.content_type,
+                    object_id__in=item_ids[start:start + IMAGE_BATCH_SIZE]).values_list('id', flat=True)
+                    if image_id not in keep_ids])
+        self.delete_images(modified_ids)
+        logging.info('%(new)d new, %(modified)d modified, %(unchanged)d unchanged, %(missing)d missing files' % stats)
+        return found
+
+    def import_images_parallel(self, found):
+        '''
+        Files are copied by pool of threads, fed through bounded queue.
+        Main thread is the only one, which works with database:
+        it inserts ``CatalogImage`` rows by batches.
+        '''
+        logging.info('=== Importing images with %d threads ===' % self.options['workers'])
+
+        workers = self.options['workers']
+        tasks = Queue(workers * 4)
+        results = Queue(workers * 4)
+
+        def copy_files():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                name, path, groups, stat, item_id = task
+                try:
+                    results.put((task, self.store_image(path, groups), file_hash(path)))
+                except Exception, e:
+                    logging.error('error: %s: %s' % (path, e))
+                    results.put((task, None, None))
+
+        def feed():
+            for task in found:
+                tasks.put(task)
+            for i in xrange(workers):
+                tasks.put(None)
+
+        threads = [Thread(target=copy_files) for i in xrange(workers)]
+        threads.append(Thread(target=feed))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        batch = []
+        for i in xrange(len(found)):
+            task, stored_name, digest = results.get()
+            if stored_name is None:
+                continue
+            name, path, groups, stat, item_id = task
+            image = CatalogImage(image=stored_name,
+                content_type=self.content_type, object_id=item_id)
+            batch.append((name, stat, digest, image))
+            if len(batch) >= IMAGE_BATCH_SIZE:
+                self.save_images(batch)
+                batch = []
+        self.save_images(batch)
+        for thread in threads:
+            thread.join()
+
+    @transaction.commit_on_success
+    def delete_images(self, image_ids):
+        '''Delete images one by one, so image files and cache are removed too'''
+        for start in xrange(0, len(image_ids), IMAGE_BATCH_SIZE):
+            for image in CatalogImage.objects.filter(id__in=image_ids[start:start + IMAGE_BATCH_SIZE]):
+                image.delete()
+
+    def save_images(self, batch):
+        '''Insert images and save manifest, so interrupted import is not repeated'''
+        self._insert_images([image for name, stat, digest, image in batch])
+        for name, stat, digest, image in batch:
+            self.manifest[name] = list(stat) + [digest, image.id]
+        self.save_manifest()
+        logging.info('%d images saved' % len(batch))
+
+    @transaction.commit_on_success
+    def _insert_images(self, images):
+        insert_objects(CatalogImage, images, key=None)
+        # stored file names are unique
+        by_name = dict([(image.image.name, image) for image in images])
+        for name, image_id in CatalogImage.objects.filter(
+                image__in=by_name.keys()).values_list('image', 'id'):
+            by_name[name].id = image_id
@@ -1,156 +1,441 @@
 # -*- coding: utf-8 -*-
+from catalog.contrib.defaults.models import Section, Item
+from catalog.contrib.defaults.settings import WHOLESALE_PRICE_FIELD
+from catalog.models import TreeItem
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand, CommandError
-from sys import argv
+from django.utils import simplejson
+from multiprocessing import Process, Queue
 from optparse import make_option
-import csv
+from Queue import Full
 from time import time
 from datetime import datetime
-from upload.models import ImportItem
 from django.template.loader import render_to_string
 from django.conf import settings
 from os import path
-from pyExcelerator import Workbook, XFStyle, Alignment, Font
+from xml.sax.saxutils import escape, quoteattr
+import csv
+import hashlib
 import logging
+import os
+
+# tree items, which items are fetched for at once
+CHUNK_SIZE = 1000
+# sections, waiting for variant writer process
+SECTION_QUEUE_SIZE = 4
+# seconds to wait for place in queue before checking writer process
+SECTION_PUT_TIMEOUT = 5
+SPLICE_MARK = '<!--catalog-price-sections-->'
+
+
+class PriceWriter(object):
+    '''
+    Base class of price list outputs. Writer is opened once, gets sections
+    in tree order with :meth:`write_section` and is closed. File is written
+    to temporary name and renamed on close.
+
+    Subclasses set ``extension``, write file start and end in
+    :meth:`write_head` and :meth:`write_tail`, section rows in
+    :meth:`write_section_title` and :meth:`write_item`, or override
+    :meth:`write_section` as a whole.
+    '''
+    extension = None
+
+    def __init__(self, variant):
+        self.variant = variant
+        self.filename = variant.filename(self.extension)
+        self.tmp_name = '%s.tmp' % self.filename
+
+    def open(self):
+        self.file = open(self.tmp_name, 'wb')
+        self.write_head()
+
+    def close(self):
+        self.write_tail()
+        self.file.close()
+        os.rename(self.tmp_name, self.filename)
+
+    def write_head(self):
+        pass
+
+    def write_section(self, section_id, name, items):
+        '''
+        Write section by tree item id, name and list of item values
+        '''
+        self.write_section_title(name)
+        for item in items:
+            self.write_item(name, item['article'] or u'', item['name'],
+                self.variant.price(item))
+
+    def write_section_title(self, name):
+        '''Row with section name, skipped by default'''
+        pass
+
+    def write_item(self, section_name, article, name, price):
+        '''Row of one item, price is None if not set'''
+        raise NotImplementedError('%s should write item rows' % self.__class__.__name__)
+
+    def write_tail(self):
+        pass
+
+
+class HtmlPriceWriter(PriceWriter):
+    '''
+    HTML page from ``catalog/price_page.html`` template. Rendered sections
+    are cached, sections with unchanged items are taken from cache
+    and spliced into the page. Page template has new name, because
+    ``catalog/price.html`` of existing projects expects ``sections`` dictionary.
+    '''
+    extension = 'html'
+
+    def open(self):
+        self.cache_dir = path.join(settings.MEDIA_ROOT, 'upload/%s-cache' % self.variant.prefix)
+        if not path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.manifest_name = path.join(self.cache_dir, 'sections.json')
+        self.manifest = self.load_manifest()
+        self.new_manifest = {}
+        super(HtmlPriceWriter, self).open()
+
+    def load_manifest(self):
+        '''Returns dictionary {section tree item id: digest of rendered items}'''
+        if self.variant.full or not path.exists(self.manifest_name):
+            return {}
+        f = open(self.manifest_name)
+        try:
+            return simplejson.load(f)
+        finally:
+            f.close()
+
+    def save_manifest(self):
+        tmp_name = '%s.tmp' % self.manifest_name
+        f = open(tmp_name, 'w')
+        try:
+            simplejson.dump(self.new_manifest, f)
+        finally:
+            f.close()
+        os.rename(tmp_name, self.manifest_name)
+
+    def write_head(self):
+        page = render_to_string('catalog/price_page.html', {
+            'title': self.variant.title(),
+            'sections_html': SPLICE_MARK,
+        }).encode('utf-8')
+        if SPLICE_MARK not in page:
+            raise CommandError('catalog/price_page.html template should output sections_html variable')
+        head, self.tail = page.split(SPLICE_MARK, 1)
+        self.file.write(head)
+
+    def section_digest(self, name, items):
+        digest = hashlib.sha1(name.encode('utf-8'))
+        for item in items:
+            digest.update(repr((item['article'], item['name'], self.variant.price(item))))
+        return digest.hexdigest()
+
+    def write_section(self, section_id, name, items):
+        digest = self.section_digest(name, items)
+        self.new_manifest[str(section_id)] = digest
+        filename = path.join(self.cache_dir, '%s.html' % section_id)
+        if self.manifest.get(str(section_id)) == digest and path.exists(filename):
+            f = open(filename)
+            try:
+                self.file.write(f.read())
+            finally:
+                f.close()
+            return
+        logging.debug('[R] %s' % name)
+        content = render_to_string('catalog/price_section.html', {
+            'section': name,
+            'items': [{
+                'article': item['article'],
+                'name': item['name'],
+                'price': self.variant.price(item),
+            } for item in items],
+        }).encode('utf-8')
+        f = open(filename, 'w')
+        f.write(content)
+        f.close()
+        self.file.write(content)
+
+    def write_tail(self):
+        self.file.write(self.tail)
+        # forget removed sections
+        for section_id in self.manifest:
+            if section_id not in self.new_manifest:
+                filename = path.join(self.cache_dir, '%s.html' % section_id)
+                if path.exists(filename):
+                    os.remove(filename)
+        self.save_manifest()
+
+
+class CsvPriceWriter(PriceWriter):
+    '''Rows of section name, article, name and price, utf-8'''
+    extension = 'csv'
+
+    def write_head(self):
+        self.writer = csv.writer(self.file, delimiter=';', quotechar='"',
+            lineterminator='\r\n', quoting=csv.QUOTE_MINIMAL)
+        self.writer.writerow([u'Раздел'.encode('utf-8'), u'Артикул'.encode('utf-8'),
+            u'Наименование'.encode('utf-8'), u'Цена'.encode('utf-8')])
+
+    def write_item(self, section_name, article, name, price):
+        self.writer.writerow([section_name.encode('utf-8'), article.encode('utf-8'),
+            name.encode('utf-8'), price is not None and str(price) or ''])
+
+
+class XmlPriceWriter(PriceWriter):
+    '''
+    Spreadsheet in XML Spreadsheet 2003 format, which Excel and OpenOffice
+    open directly. Rows are written one by one, no workbook in memory.
+    File has ``xml`` extension, Excel warns about other formats in ``xls`` files.
+    '''
+    extension = 'xml'
+
+    def cell(self, value, style=None, merge=None):
+        attrs = ''
+        if style is not None:
+            attrs += ' ss:StyleID="%s"' % style
+        if merge is not None:
+            attrs += ' ss:MergeAcross="%d"' % merge
+        if value is None:
+            return '<Cell%s/>' % attrs
+        if isinstance(value, basestring):
+            data = '<Data ss:Type="String">%s</Data>' % escape(value).encode('utf-8')
+        else:
+            data = '<Data ss:Type="Number">%s</Data>' % value
+        return '<Cell%s>%s</Cell>' % (attrs, data)
+
+    def row(self, *cells):
+        self.file.write('<Row>%s</Row>\n' % ''.join(cells))
+
+    def write_head(self):
+        self.file.write('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<?mso-application progid="Excel.Sheet"?>\n'
+            '<Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet"'
+            ' xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet">\n'
+            '<Styles>\n'
+            '<Style ss:ID="header"><Font ss:Bold="1" ss:Size="20"/></Style>\n'
+            '<Style ss:ID="section"><Font ss:Bold="1"/><Alignment ss:Horizontal="Center"/></Style>\n'
+            '</Styles>\n')
+        self.file.write('<Worksheet ss:Name=%s>\n<Table>\n'
+            '<Column ss:Index="2" ss:Width="210"/>\n' % quoteattr(u'Прайс соло-парфюм').encode('utf-8'))
+        self.row(self.cell(self.variant.title(), style='header', merge=2))
+        self.row()
+        self.row(self.cell(u'Артикул'), self.cell(u'Наименование'), self.cell(u'Цена'))
+
+    def write_section_title(self, name):
+        self.row(self.cell(name, style='section', merge=2))
+
+    def write_item(self, section_name, article, name, price):
+        self.row(self.cell(article), self.cell(name), self.cell(price))
+
+    def write_tail(self):
+        self.file.write('</Table>\n</Worksheet>\n</Workbook>\n')
+
+
+class PriceVariant(object):
+    '''Retail or wholesale price list, written to all outputs'''
+    writer_classes = [HtmlPriceWriter, CsvPriceWriter, XmlPriceWriter]
+
+    def __init__(self, whole, full=False):
+        self.whole = whole
+        self.full = full
+        if whole:
+            self.price_field = WHOLESALE_PRICE_FIELD
+            self.prefix = 'wprice'
+        else:
+            self.price_field = 'price'
+            self.prefix = 'price'
+        self.writers = [writer_cls(self) for writer_cls in self.writer_classes]
+
+    def filename(self, extension):
+        return path.join(settings.MEDIA_ROOT, 'upload/%s.%s' % (self.prefix, extension))
+
+    def title(self):
+        if self.whole:
+            return u'Оптовый прайс-лист Соло-парфюм (%s)' % datetime.now().strftime('%d.%m.%Y')
+        else:
+            return u'Прайс-лист Соло-парфюм (%s)' % datetime.now().strftime('%d.%m.%Y')
+
+    def price(self, item):
+        return item[self.price_field]
+
+    def open(self):
+        for writer in self.writers:
+            writer.open()
+
+    def write_section(self, section_id, name, items):
+        for writer in self.writers:
+            writer.write_section(section_id, name, items)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def variant_worker(variant, sections):
+    '''Writer process: writes sections from queue until None'''
+    variant.open()
+    while True:
+        section = sections.get()
+        if section is None:
+            break
+        variant.write_section(*section)
+    variant.close()
 
 
 class Command(BaseCommand):
-    help = '''Import items to template price'''
+    help = '''Make price list from catalog items.
+    Sections, which items were not changed since last run, are taken from cache
+    '''
 
     option_list = BaseCommand.option_list + (
         make_option('--verbose', default=None, dest='verbose', type='int',
             help='Verbose level 0, 1 or 2 (0 by default)'),
         make_option('--whole', default=False, dest='whole', type='string',
             help='wholeprice'),
+        make_option('--both', default=False, dest='both', action='store_true',
+            help='Make retail and wholesale price in one pass, by two processes'),
+        make_option('--full', default=False, dest='full', action='store_true',
+            help='Render all sections, do not use cached ones'),
     )
-    
+
     def handle(self, *args, **options):
         start_time = time()
         self.options = options
-        
+
         if self.options['verbose'] == 2:
             logging.getLogger().setLevel(logging.DEBUG)
         elif self.options['verbose'] == 1:
             logging.getLogger().setLevel(logging.INFO)
         elif self.options['verbose'] == 0:
             logging.getLogger().setLevel(logging.ERROR)
-        
-        last_item = ImportItem.objects.filter(ok=True).latest('date_loaded')
-        if not last_item:
-            raise CommandError('No import files')
-        src = last_item.file.path
-        
-        class csv_format(csv.Dialect):
-            delimiter = ';'
-            quotechar = '"'
-            doublequote = True
-            lineterminator = '\r\n'
-            quoting = csv.QUOTE_MINIMAL
-
-        reader = csv.reader(open(src, 'r'), dialect=csv_format)
-        count = 0
-        
-        if self.options['verbose'] >= 1:
-            logging.info('Importing items')
-        
-        for item in reader:
-            try:
-                self.make_item(item)
-            except ValueError:
-                if self.options['verbose'] >= 2:
-                    logging.error('Error importing record: %s' % item)
-            count = count + 1
-        self.write_html_price()
-        self.write_xls_price()
 
-    def __init__(self):
-        self.data = {}
+        if self.options['both']:
+            self.variants = [PriceVariant(False, self.options['full']),
+                PriceVariant(True, self.options['full'])]
+        else:
+            self.variants = [PriceVariant(bool(self.options['whole']), self.options['full'])]
+        for variant in self.variants:
+            if not path.isdir(path.dirname(variant.filename('html'))):
+                os.makedirs(path.dirname(variant.filename('html')))
 
-    def _get_or_create_section(self, name):
-        if name not in self.data:
-            self.data.update({name: []})
-        return name
+        logging.info('Writing price')
+        if len(self.variants) == 1:
+            self.write_price()
+        else:
+            self.write_price_parallel()
 
-    def _create_item(self, **kwds):
-        
-        if int(kwds['quantity']) > 0:
-            self.data[kwds['parent']].append(kwds)
+        work_time = time() - start_time
+        logging.info('price updated in %s s' % work_time)
 
+    def write_price(self):
+        variant = self.variants[0]
+        variant.open()
+        for section in self.iter_sections():
+            variant.write_section(*section)
+        variant.close()
 
-    def make_item(self, param_list):
+    def write_price_parallel(self):
         '''
-        Makes a new item in catalog
-        param_list = [identifier, quantity, '<section_name> <name>']
+        Items are read once, every section is sent to writer process
+        of each variant through bounded queue
         '''
-        options = {}
-        options['identifier'] = param_list[0]
-        options['quantity'] = param_list[1]
-        if self.options['whole']:
-            options['price'] = param_list[4]
-        else:
-            options['price'] = param_list[5]
-        if len(param_list) == 7:
-            options['barcode'] = param_list[6]
-        else:
-            options['barcode'] = None
-        options['name'] = param_list[3].decode('cp1251').replace('""', '"')
-        options['short_description'] = options['name'].split(' ').pop()
-        section_name = param_list[2].decode('cp1251')
-        section = self._get_or_create_section(section_name)
-        options['parent'] = section
-
-        return self._create_item(**options)
-    
-    def write_html_price(self):
-        content = render_to_string('catalog/price.html', {'sections': self.data})
-        if self.options['whole']:
-            filename = path.join(settings.MEDIA_ROOT, 'upload/wprice.html')
-        else:
-            filename = path.join(settings.MEDIA_ROOT, 'upload/price.html')
+        queues = [Queue(SECTION_QUEUE_SIZE) for variant in self.variants]
+        processes = [Process(target=variant_worker, args=(variant, queue))
+            for variant, queue in zip(self.variants, queues)]
+        for process in processes:
+            process.start()
+        try:
+            for section in self.iter_sections():
+                self.put_section(section, queues, processes)
+            self.put_section(None, queues, processes)
+        except:
+            for queue, process in zip(queues, processes):
+                # do not wait for sections, which nobody reads
+                queue.cancel_join_thread()
+                process.terminate()
+            raise
+        for process in processes:
+            process.join()
+        for variant, process in zip(self.variants, processes):
+            if process.exitcode:
+                raise CommandError('Price %s was not written' % variant.prefix)
 
-        f = open(filename, 'w')
-        f.write(content.encode('utf-8'))
-        f.close()
+    def put_section(self, section, queues, processes):
+        '''
+        Send section to every writer process. Writers exit only after
+        None section, so stopped writer means failure, feeding stops.
+        '''
+        for variant, queue, process in zip(self.variants, queues, processes):
+            while True:
+                if not process.is_alive():
+                    raise CommandError('Price %s was not written, writer exited with code %s' % (
+                        variant.prefix, process.exitcode))
+                try:
+                    queue.put(section, True, SECTION_PUT_TIMEOUT)
+                    break
+                except Full:
+                    pass
 
-    def write_xls_price(self):
-        if self.options['whole']:
-            filename = path.join(settings.MEDIA_ROOT, 'upload/wprice.xls')
-        else:
-            filename = path.join(settings.MEDIA_ROOT, 'upload/price.xls')
-        workBookDocument = Workbook()
-        docSheet = workBookDocument.add_sheet(u'Прайс соло-парфюм')
-        docSheet.col(1).width = 10000
-        headerFont = Font()
-        headerFont.bold = True
-        headerFont.size = 400
-        headerStyle = XFStyle()
-        headerStyle.font = headerFont
-        docSheet.row(0).set_style(headerStyle)
-        if self.options['whole']:
-            docSheet.write_merge(0, 0, 0, 2, u'Оптовый прайс-лист Соло-парфюм (%s)' % datetime.now().strftime('%d.%m.%Y'))
-        else:
-            docSheet.write_merge(0, 0, 0, 2, u'Прайс-лист Соло-парфюм (%s)' % datetime.now().strftime('%d.%m.%Y'))
-
-        docSheet.write(2, 0, u'Артикул')
-        docSheet.write(2, 1, u'Наименование', )
-        docSheet.write(2, 2, u'Цена')
-
-        sectionFont = Font()
-        sectionFont.bold = True
-        sectionStyle = XFStyle()
-        sectionStyle.font = sectionFont
-        align = Alignment()
-        align.horz = Alignment.HORZ_CENTER
-        sectionStyle.alignment = align
-
-        row = 3
-        for section in self.data.iterkeys():
-            docSheet.write_merge(row, row, 0, 2, section, sectionStyle)
-            row += 1
-            for item in self.data[section]:
-                docSheet.write(row, 0, item['identifier'])
-                docSheet.write(row, 1, item['name'])
-                docSheet.write(row, 2, item['price'])
-                row += 1
-
-        workBookDocument.save(filename)
+    def iter_sections(self):
+        '''
+        Yields (section tree item id, section name, list of item values)
+        for published items in stock. Items are streamed by one query,
+        ordered by ``lft`` of their section, then by own ``lft``.
+        '''
+        section_ct = ContentType.objects.get_for_model(Section)
+        item_ct = ContentType.objects.get_for_model(Item)
+        section_names = dict(Section.objects.values_list('id', 'name'))
+        section_by_treeitem = dict([(treeitem_id, section_names.get(object_id, u''))
+            for treeitem_id, object_id in TreeItem.objects.filter(
+                content_type=section_ct).values_list('id', 'object_id')])
+
+        rows = TreeItem.objects.filter(content_type=item_ct, is_published=True).order_by(
+            'parent__tree_id', 'parent__lft', 'lft').values_list('parent', 'object_id')
+        fields = ['id', 'article', 'name']
+        for variant in self.variants:
+            if variant.price_field not in fields:
+                fields.append(variant.price_field)
 
+        current_id, current_items = None, []
+        for section_id, items in self._iter_groups(rows, fields):
+            if section_id != current_id:
+                if current_items:
+                    yield current_id, section_by_treeitem.get(current_id, u''), current_items
+                current_id, current_items = section_id, []
+            current_items.extend(items)
+        if current_items:
+            yield current_id, section_by_treeitem.get(current_id, u''), current_items
+
+    def _iter_groups(self, rows, fields):
+        '''Fetch item values for rows by chunks'''
+        chunk = []
+        for row in rows.iterator():
+            chunk.append(row)
+            if len(chunk) == CHUNK_SIZE:
+                for group in self._fetch_items(chunk, fields):
+                    yield group
+                chunk = []
+        for group in self._fetch_items(chunk, fields):
+            yield group
+
+    def _fetch_items(self, chunk, fields):
+        '''
+        Returns [(section tree item id, [item values, ...]), ...]
+        for chunk of (parent id, item id) rows, in chunk order
+        '''
+        if not chunk:
+            return []
+        values = dict([(item['id'], item) for item in Item.objects.filter(
+            id__in=[object_id for parent_id, object_id in chunk]).exclude(
+            quantity__lte=0).values(*fields)])
+        groups = []
+        for parent_id, object_id in chunk:
+            if object_id not in values:
+                continue
+            item = values[object_id]
+            if not groups or groups[-1][0] != parent_id:
+                groups.append((parent_id, []))
+            groups[-1][1].append(item)
+        return groups
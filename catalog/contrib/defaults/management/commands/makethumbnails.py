@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from catalog.contrib.defaults.models import CatalogImage
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+from time import time, mktime, strptime
+import logging
+
+# images in one task of worker process
+TASK_SIZE = 20
+
+def generate_variants(task):
+    '''
+    Worker process: create cache files of all specs for chunk of images.
+    Variants newer than source image are skipped, older ones are recreated.
+    Returns list of (spec name, status, seconds), where status is
+    'created', 'skipped' or 'error'.
+    '''
+    images, since = task
+    results = []
+    for image_id, name in images:
+        # no database queries in worker, instance is built from values
+        image = CatalogImage(id=image_id, image=name)
+        storage = image._imgfield.storage
+        try:
+            source_mtime = storage.modified_time(name)
+        except (OSError, NotImplementedError), e:
+            logging.error('error: %s: %s' % (name, e))
+            continue
+        if since is not None and source_mtime < since:
+            continue
+        for spec in image._ik.specs:
+            start = time()
+            accessor = getattr(image, spec.name())
+            try:
+                if storage.exists(accessor.name):
+                    if storage.modified_time(accessor.name) >= source_mtime:
+                        results.append((spec.name(), 'skipped', 0))
+                        continue
+                    storage.delete(accessor.name)
+                accessor._create()
+            except Exception, e:
+                logging.error('error: %s, %s: %s' % (name, spec.name(), e))
+                results.append((spec.name(), 'error', time() - start))
+            else:
+                results.append((spec.name(), 'created', time() - start))
+    return results
+
+
+class Command(BaseCommand):
+    help = '''Generate cached variants of catalog images for all imagekit specs
+    Usage: manage.py makethumbnails [--since "2011-05-01 12:00"]
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--verbose', default=0, dest='verbose', type='int',
+            help='Verbose level 0, 1 or 2 (0 by default)'),
+        make_option('--workers', default=cpu_count(), dest='workers', type='int',
+            help='Number of worker processes (number of CPUs by default)'),
+        make_option('--since', default=None, dest='since',
+            help='Process only images, changed after given date, '
+                'format: "YYYY-MM-DD" or "YYYY-MM-DD HH:MM"'),
+    )
+
+    def parse_since(self, value):
+        for date_format in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+            try:
+                return datetime.fromtimestamp(mktime(strptime(value, date_format)))
+            except ValueError:
+                pass
+        raise CommandError('Wrong --since date: %s' % value)
+
+    def handle(self, *args, **options):
+        start_time = time()
+        self.options = options
+
+        if self.options['verbose'] == 2:
+            logging.getLogger().setLevel(logging.DEBUG)
+        elif self.options['verbose'] == 1:
+            logging.getLogger().setLevel(logging.INFO)
+        elif self.options['verbose'] == 0:
+            logging.getLogger().setLevel(logging.ERROR)
+
+        since = None
+        if self.options['since']:
+            since = self.parse_since(self.options['since'])
+
+        images = list(CatalogImage.objects.exclude(image='').values_list('id', 'image'))
+        tasks = [(images[start:start + TASK_SIZE], since)
+            for start in xrange(0, len(images), TASK_SIZE)]
+        logging.info('%d images, %d workers' % (len(images), self.options['workers']))
+
+        # spec name: {status: count}, spec name: seconds
+        counts, seconds = {}, {}
+        pool = Pool(self.options['workers'])
+        try:
+            for results in pool.imap_unordered(generate_variants, tasks):
+                for spec_name, status, duration in results:
+                    spec_counts = counts.setdefault(spec_name, {'created': 0, 'skipped': 0, 'error': 0})
+                    spec_counts[status] += 1
+                    seconds[spec_name] = seconds.get(spec_name, 0) + duration
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        pool.join()
+
+        for spec_name in sorted(counts.keys()):
+            spec_counts = counts[spec_name]
+            rate = 0
+            if seconds[spec_name]:
+                rate = spec_counts['created'] / seconds[spec_name]
+            logging.info('%s: %d created, %d skipped, %d errors, %.1f images/s per process' % (
+                spec_name, spec_counts['created'], spec_counts['skipped'],
+                spec_counts['error'], rate))
+        logging.info('thumbnails updated in %s s' % (time() - start_time))
@@ -3,10 +3,12 @@ from catalog import settings as catalog_settings
 from catalog.contrib.defaults.settings import UPLOAD_ROOT
 #from catalog.models import TreeItem
 from catalog.base import CatalogBase 
+from catalog.utils import ID_PLACEHOLDER, url_template
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.db import models
+from django.utils.encoding import iri_to_uri
 from django.utils.translation import ugettext_lazy as _
 from django.db.models import permalink
 
@@ -24,6 +26,59 @@ except ImportError:
     from django.db.models import Model as ImageModel
 
 
+SLUG_PLACEHOLDER = '--catalog-slug--'
+
+# cache {model_cls: url format string}
+_url_templates = {}
+
+def _build_url_template(model_cls):
+    '''
+    Detect installed catalog urlconf and make format string
+    with ``%(slug)s`` or ``%(id)s`` placeholder for model
+    '''
+    model_name = model_cls.__name__.lower()
+    try:
+        url = reverse('catalog-by-slug', kwargs={
+            'model': model_name,
+            'slug': SLUG_PLACEHOLDER,
+        })
+    except NoReverseMatch:
+        pass
+    else:
+        return url.replace('%', '%%').replace(SLUG_PLACEHOLDER, '%(slug)s')
+    try:
+        # catalog.views.item_view looks up object_id in model queryset
+        return url_template('catalog-by-id', '%(id)s', kwargs={
+            'model': model_name,
+            'object_id': ID_PLACEHOLDER,
+        })
+    except NoReverseMatch:
+        pass
+    raise NoReverseMatch('No appropriate methods found, take a look in the code')
+
+def get_url_template(model_cls):
+    if model_cls not in _url_templates:
+        _url_templates[model_cls] = _build_url_template(model_cls)
+    return _url_templates[model_cls]
+
+def reset_url_templates():
+    '''Forget detected urls, call it when ROOT_URLCONF changes'''
+    _url_templates.clear()
+
+def get_absolute_urls(objects):
+    '''
+    Returns list of urls for given catalog objects,
+    urlconf is reversed only once per model
+    '''
+    urls = []
+    for obj in objects:
+        urls.append(iri_to_uri(get_url_template(obj.__class__) % {
+            'slug': obj.slug,
+            'id': obj.id,
+        }))
+    return urls
+
+
 class CommonFields(CatalogBase):
     class Meta:
         abstract = True
@@ -39,26 +94,7 @@ class CommonFields(CatalogBase):
     description = models.TextField(verbose_name=_('Section description'), null=True, blank=True)
     
     def get_absolute_url(self):
-        try:
-            # test if catalog-by-slug installed
-            reverse('catalog-by-slug', kwargs={'model': 'model', 'slug': 'slug'})
-        except NoReverseMatch:
-            pass
-        else:
-            return reverse('catalog-by-slug', kwargs={
-                'model': self.__class__.__name__.lower(),
-                'slug': self.slug,
-            })
-        try:
-            reverse('catalog-by-id', kwargs={'slug': 'slug', 'object_id': '1'})
-        except NoReverseMatch:
-            pass
-        else:
-            return reverse('catalog-by-id', kwargs={
-                'slug': self.slug,
-                'object_id': self.tree.get().id,
-            })
-        raise NoReverseMatch('No appropriate methods found, take a look in the code')
+        return get_absolute_urls([self])[0]
 
 
 class Section(CommonFields, models.Model):
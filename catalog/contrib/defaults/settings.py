@@ -3,3 +3,6 @@ from django.conf import settings
 UPLOAD_ROOT = getattr(settings, 'UPLOAD_ROOT', 'upload')
 
 #settings.CATALOG_FILTERS = dict(show=True)
+
+# Item field with wholesale price, used by ``makeprice --whole``
+WHOLESALE_PRICE_FIELD = getattr(settings, 'CATALOG_WHOLESALE_PRICE_FIELD', 'price')
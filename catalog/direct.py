@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
-from catalog.models import TreeItem
-from catalog.utils import connected_models
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from catalog import settings as catalog_settings
+from catalog.bulk import delete_subtrees, move_subtrees
+from catalog.models import TreeItem, get_tree_version
+from catalog.snapshot import get_snapshot
+from catalog.utils import ID_PLACEHOLDER, connected_models, registry, url_template
 from django.contrib import admin
 from django.core import urlresolvers
+from django.core.cache import cache
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.core.serializers import serialize
-from django.db.models import loading
+from django.core.serializers import serialize, get_serializer
+from django.db.models import loading, FieldDoesNotExist, Q, Max
 from django.utils import simplejson
 from extdirect.django import ExtDirectStore
 from extdirect.django.decorators import remoting
@@ -15,18 +20,136 @@ from extdirect.django.providers import ExtRemotingProvider
 provider = ExtRemotingProvider(namespace='Catalog',
     url='/admin/catalog/treeitem/direct/router/', id='catalog_provider')
 
+def exact_count(queryset, parent):
+    return queryset.count(), False
+
+def cached_count(queryset, parent):
+    '''
+    Count is cached per parent node, key contains tree version,
+    so any tree modification invalidates it
+    '''
+    key = 'catalog_grid_count:%s:%s' % (get_tree_version(), parent or 'root')
+    total = cache.get(key)
+    if total is None:
+        total = queryset.count()
+        cache.set(key, total)
+    return total, False
+
+def estimated_count(queryset, parent):
+    '''
+    Estimate children count without counting rows.
+    For parent node it is descendants count from lft/rght span,
+    for root level - number of trees.
+    '''
+    if parent is None:
+        total = TreeItem.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0
+    else:
+        spans = TreeItem.objects.filter(id=parent).values_list('lft', 'rght')
+        if not spans:
+            return 0, False
+        lft, rght = spans[0]
+        total = (rght - lft - 1) / 2
+    return total, True
+
+COUNT_STRATEGIES = {
+    'exact': exact_count,
+    'cached': cached_count,
+    'estimated': estimated_count,
+}
+
+def get_count_strategy(strategy=None):
+    '''Returns count function by name, by default from CATALOG_GRID_COUNT setting'''
+    if strategy is None:
+        strategy = catalog_settings.CATALOG_GRID_COUNT
+    if callable(strategy):
+        return strategy
+    return COUNT_STRATEGIES[strategy]
+
+
+CURSOR_NEXT = 'n'
+CURSOR_PREV = 'p'
+
+def encode_cursor(direction, treeitem):
+    '''Opaque cursor pointing before or after given tree item'''
+    return urlsafe_b64encode('%s:%d:%d' % (direction, treeitem.tree_id, treeitem.lft))
+
+def decode_cursor(cursor):
+    '''Returns (direction, tree_id, lft) tuple or None for invalid cursor'''
+    try:
+        direction, tree_id, lft = urlsafe_b64decode(str(cursor)).split(':')
+        if direction not in (CURSOR_NEXT, CURSOR_PREV):
+            return None
+        return direction, int(tree_id), int(lft)
+    except (TypeError, ValueError):
+        return None
+
+
 class CatalogGridStore(ExtDirectStore):
 
     def __init__(self, *args, **kwds):
         # Force model=TreeItem
         args += (TreeItem,)
+        self.cursor = kwds.pop('cursor', 'cursor')
+        self.count = get_count_strategy(kwds.pop('count_strategy', None))
         return super(CatalogGridStore, self).__init__(*args, **kwds)
 
+    def cursor_page(self, queryset, cursor, limit):
+        '''
+        Keyset pagination over ``(tree_id, lft)``, same as ``TreeItem.Meta.ordering``.
+        Returns objects list, previous and next page cursors.
+        '''
+        position = decode_cursor(cursor)
+        if position is None:
+            direction = CURSOR_NEXT
+            page_qs = queryset.order_by('tree_id', 'lft')
+        else:
+            direction, tree_id, lft = position
+            if direction == CURSOR_NEXT:
+                page_qs = queryset.filter(Q(tree_id__gt=tree_id) |
+                    Q(tree_id=tree_id, lft__gt=lft)).order_by('tree_id', 'lft')
+            else:
+                page_qs = queryset.filter(Q(tree_id__lt=tree_id) |
+                    Q(tree_id=tree_id, lft__lt=lft)).order_by('-tree_id', '-lft')
+
+        # fetch one extra row to know if there is one more page
+        objects = list(page_qs[:limit + 1])
+        has_more = len(objects) > limit
+        objects = objects[:limit]
+        if direction == CURSOR_PREV:
+            objects.reverse()
+
+        if not objects:
+            return objects, None, None
+        if direction == CURSOR_NEXT:
+            has_prev, has_next = position is not None, has_more
+        else:
+            has_prev, has_next = has_more, True
+        prev_cursor = has_prev and encode_cursor(CURSOR_PREV, objects[0]) or None
+        next_cursor = has_next and encode_cursor(CURSOR_NEXT, objects[-1]) or None
+        return objects, prev_cursor, next_cursor
+
     def query(self, qs=None, **kw):
         paginate = False
         total = None
         order = False
 
+        if kw.has_key(self.cursor) and kw.has_key(self.limit):
+            cursor = kw.pop(self.cursor)
+            limit = kw.pop(self.limit)
+            kw.pop(self.start, None)
+            if not qs is None:
+                queryset = qs
+            else:
+                queryset = self.model.objects
+            queryset = queryset.filter(**kw)
+
+            objects, prev_cursor, next_cursor = self.cursor_page(queryset, cursor, limit)
+            total, estimated = self.count(queryset, kw.get('parent'))
+            res = self.serialize(objects, total)
+            res.update({'prev': prev_cursor, 'next': next_cursor,
+                'total_estimated': estimated})
+            return res
+
         if kw.has_key(self.start) and kw.has_key(self.limit):
             start = kw.pop(self.start)
             limit = kw.pop(self.limit)
@@ -41,23 +164,27 @@ class CatalogGridStore(ExtDirectStore):
             queryset = self.model.objects
 
         queryset = queryset.filter(**kw)
+        total, estimated = self.count(queryset, kw.get('parent'))
 
         if not paginate:
             objects = queryset
-            total = queryset.count()
         else:
             paginator = Paginator(queryset, limit)
-            total = paginator.count
+            # don't let paginator run its own COUNT(*)
+            paginator._count = total
 
             try:
-                page = paginator.page(start + 1)
+                # ExtJS sends row offset in ``start``
+                page = paginator.page(int(start) // int(limit) + 1)
             except (EmptyPage, InvalidPage):
                 #out of range, deliver last page of results.
                 page = paginator.page(paginator.num_pages)
 
             objects = page.object_list
 
-        return self.serialize(objects, total)
+        res = self.serialize(objects, total)
+        res['total_estimated'] = estimated
+        return res
 
     def serialize(self, queryset, total=None):
         meta = {
@@ -67,6 +194,25 @@ class CatalogGridStore(ExtDirectStore):
         res = serialize('catalog_extdirect', queryset, meta=meta, extras=self.extras, total=total)
         return res
 
+    def stream(self, qs=None, **kw):
+        '''
+        Unpaginated query, returns iterable of JSON chunks
+        which can be passed to ``HttpResponse`` directly
+        '''
+        if not qs is None:
+            queryset = qs
+        else:
+            queryset = self.model.objects
+        queryset = queryset.filter(**kw)
+
+        meta = {
+            'root': self.root,
+            'total' : self.total
+        }
+        total, estimated = self.count(queryset, kw.get('parent'))
+        serializer = get_serializer('catalog_extdirect')()
+        return serializer.serialize_iter(queryset, meta=meta, extras=self.extras, total=total)
+
 
 class Column(object):
     _map = {
@@ -136,6 +282,30 @@ class Column(object):
         return serialized
 
 
+def compile_accessor(name, model_cls, model_admin_cls):
+    '''
+    Returns function, which takes model instance and returns column value.
+    Mirrors ``admin.util.lookup_field`` name resolution, but does it once per model.
+    '''
+    try:
+        model_cls._meta.get_field(name)
+    except FieldDoesNotExist:
+        if callable(name):
+            return name
+        elif (hasattr(model_admin_cls, name) and
+          not name == '__str__' and not name == '__unicode__'):
+            return getattr(model_admin_cls, name)
+        else:
+            def accessor(obj):
+                attr = getattr(obj, name)
+                if callable(attr):
+                    return attr()
+                return attr
+            return accessor
+    else:
+        return lambda obj: getattr(obj, name)
+
+
 class ColumnModel(object):
     '''Represents python-ExtJS map of types for grid'''
 
@@ -145,11 +315,12 @@ class ColumnModel(object):
         Reads data from django models loader and given site registry
         '''
         self.model_cache = loading.cache
-        self.admin_registry = site._registry
+        self.site = site
         self.fields = {}
+        self._row_specs = {}
 
         for model_cls in connected_models():
-            admin_cls = self.admin_registry[model_cls]
+            admin_cls = registry.get_admin_class(model_cls, site)
 
             list_display = list(admin_cls.list_display)
             if 'action_checkbox' in list_display:
@@ -165,10 +336,50 @@ class ColumnModel(object):
 
     def serialize(self):
         '''Serialize ColumnModel object to list of serialized Columns'''
-        serialized = []
-        for column in self.fields.itervalues():
-            serialized.append(column.serialize())
-        return sorted(serialized, key=lambda x: x['order'])
+        if not hasattr(self, '_serialized'):
+            serialized = []
+            for column in self.fields.itervalues():
+                serialized.append(column.serialize())
+            self._serialized = sorted(serialized, key=lambda x: x['order'])
+        return self._serialized
+
+    def get_row_spec(self, model_cls):
+        '''
+        Returns compiled list of (column name, accessor) pairs and
+        admin change url format string for model
+        '''
+        if model_cls not in self._row_specs:
+            admin_cls = registry.get_admin_class(model_cls, self.site)
+            opts = model_cls._meta
+            accessors = [(name, compile_accessor(name, model_cls, admin_cls))
+                for name in self.fields.iterkeys()]
+            url = url_template('admin:%s_%s_change' %
+                (opts.app_label, opts.module_name), args=[ID_PLACEHOLDER])
+            self._row_specs[model_cls] = (accessors, url)
+        return self._row_specs[model_cls]
+
+
+# cache {id(site): (registry_key, ColumnModel instance)}
+_column_models = {}
+
+def _registry_key(site):
+    '''Identifies state of connected models registration in admin site'''
+    return tuple([(model_cls, id(site._registry.get(model_cls)))
+        for model_cls in connected_models()])
+
+def get_column_model(site):
+    '''
+    Returns ColumnModel for admin site. Column model is built once
+    and rebuilt only when connected models admin registration changes.
+    '''
+    key = _registry_key(site)
+    cached = _column_models.get(id(site))
+    if cached is None or cached[0] != key:
+        # registration changed, cached admin classes are stale too
+        registry.reset_admin_classes()
+        cached = (key, ColumnModel(site))
+        _column_models[id(site)] = cached
+    return cached[1]
 
 
 @remoting(provider, action='treeitem', len=1)
@@ -183,34 +394,72 @@ def objects(request):
         parent = None
 
     items = CatalogGridStore()
-    res = items.query(parent=parent)
+    kw = {'parent': parent}
+    # paging parameters, ``cursor`` enables keyset pagination
+    for param in (items.start, items.limit, items.cursor):
+        if param in data:
+            kw[str(param)] = data[param]
+    res = items.query(TreeItem.objects.with_content_objects(), **kw)
     return res
 
 @remoting(provider, action="treeitem", len=1)
 def remove_objects(request):
     data = request.extdirect_post_data[0]
-    for object_id in data.get('objects'):
-        TreeItem.objects.get(id=object_id).delete()
+    delete_subtrees(data.get('objects'))
     return True
 
+def tree_nodes(snapshot, parent, depth):
+    '''
+    Tree nodes data for ExtJS TreeLoader, nested ``depth`` levels deep.
+    Nodes without descendants get empty ``children`` list, so
+    UI doesn't request them.
+    '''
+    data = []
+    for child_id in snapshot.children(parent):
+        leaf = getattr(snapshot.model_class(child_id), 'leaf', False)
+        descendants = snapshot.descendant_count(child_id)
+        node = {
+            'leaf': leaf,
+            'id': child_id,
+            'descendants': descendants,
+        }
+        if not leaf:
+            if descendants == 0:
+                node['children'] = []
+            elif depth > 1:
+                node['children'] = tree_nodes(snapshot, child_id, depth - 1)
+        data.append(node)
+    return data
+
+def set_node_titles(snapshot, data):
+    '''Set ``text`` of nested nodes, titles are fetched only for these nodes'''
+    nodes = list(data)
+    for node in nodes:
+        nodes.extend(node.get('children', []))
+    snapshot.load_titles([node['id'] for node in nodes])
+    for node in nodes:
+        node['text'] = snapshot.title(node['id'])
+
 @remoting(provider, action='treeitem', len=1)
 def tree(request):
     '''
-    Server-side expand of tree structure implementation
+    Server-side expand of tree structure implementation.
+    Accepts node id or hash with ``node`` and ``depth`` keys.
     '''
     node = request.extdirect_post_data[0]
+    depth = 1
+    if isinstance(node, dict):
+        depth = int(node.get('depth', 1))
+        node = node.get('node', 'root')
+
     if node == 'root':
         node = None
-    
-    children = TreeItem.objects.filter(parent=node)
-    data = []
-    for item in children:
-        data.append({
-            'leaf': getattr(item.content_object, 'leaf', False),
-            'id': item.id,
-            'text': unicode(item.content_object),
-        })
-    
+    else:
+        node = int(node)
+
+    snapshot = get_snapshot()
+    data = tree_nodes(snapshot, node, depth)
+    set_node_titles(snapshot, data)
     return simplejson.dumps(data)
 
 @remoting(provider, action='treeitem', len=1, form_handler=False)
@@ -226,13 +475,9 @@ def move_to(request):
         elif item.get('point') == 'append':
             position = 'last-child'
         
-        for src_id in source:
-            if src_id == target:
-                continue
-            if target == 'root':
-                TreeItem.objects.get(id=src_id).move_to(None, position)
-            else:
-                TreeItem.objects.get(id=src_id).move_to(TreeItem.objects.get(id=target), position)
+        if target == 'root':
+            target = None
+        move_subtrees(source, target, position)
 
     return dict(success=True)
 
@@ -251,5 +496,5 @@ def get_col_model(request):
     Returns JSON configuration which should be passed into 
     ext.grid.ColumnModel() constructor
     '''
-    return ColumnModel(admin.site).serialize()
+    return get_column_model(admin.site).serialize()
 
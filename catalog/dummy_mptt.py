@@ -82,6 +82,10 @@ def move_to(self, new_parent, position):
 
 
 def get_level(self):
+    path = getattr(self, 'path', None)
+    if path is not None:
+        # stored ancestors path, see catalog.models.TreeItem.path
+        return path.count('/')
     level = 0
     obj = self
     for i in range(10):
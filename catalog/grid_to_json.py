@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 from extdirect.django.serializer import Serializer as ExtSerializer
 from StringIO import StringIO
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
 from django.utils.encoding import smart_str, smart_unicode
 from django.utils import datetime_safe
 from catalog.models import Link
-from catalog.direct import ColumnModel
+from catalog.direct import get_column_model
 from django.contrib import admin
-from django.core import urlresolvers
 
 LINK_OBJECT = 0
 REAL_OBJECT = 1
@@ -14,7 +15,8 @@ REAL_OBJECT = 1
 
 class Serializer(ExtSerializer):
     """Overrides functions defined in extdirect.django.
-    Field lookups narrowed to ColumnModel query
+    Field lookups narrowed to ColumnModel query, field accessors and
+    admin urls are compiled once per model, see ``ColumnModel.get_row_spec``
     """
     def start_object(self, obj):
         self._current = {}
@@ -24,21 +26,18 @@ class Serializer(ExtSerializer):
         else:
             self._content_object = obj.content_object
             self._type = REAL_OBJECT
-        self._admin_cls = admin.site._registry[type(self._content_object)]
+        self._accessors, self._url_template = self.colmodel.get_row_spec(
+            type(self._content_object))
 
-    def handle_field(self, obj, field):
+    def handle_field(self, obj, name, accessor):
         try:
-            value = admin.util.lookup_field(field.name, self._content_object, self._admin_cls)[2]
+            value = accessor(self._content_object)
         except AttributeError:
             value = ''
-        self._current[field.name] = smart_unicode(value, strings_only=True)
+        self._current[name] = smart_unicode(value, strings_only=True)
 
     def handle_model(self, obj):
-        url = urlresolvers.reverse('admin:%s_%s_change' %
-            (obj.content_object._meta.app_label, obj.content_object._meta.module_name),
-            args=[obj.object_id],
-        )
-        self._current['url'] = url
+        self._current['url'] = self._url_template % obj.object_id
 
     def serialize(self, queryset, **options):
         """
@@ -48,16 +47,50 @@ class Serializer(ExtSerializer):
         self.stream = options.get("stream", StringIO())
         self.meta = options.get('meta', dict(root='records', total='total'))
         self.extras = options.get('extras', [])
-        total = options.get("total", queryset.count())
+        # count only if caller has no total, objects may be a list
+        total = options.get('total')
+        if total is None:
+            total = queryset.count()
         self.start_serialization(total)
 
-        colmodel = ColumnModel(admin.site)
-        fields = colmodel.fields.values()
+        self.colmodel = get_column_model(admin.site)
         for obj in queryset:
             self.start_object(obj)
-            for field in fields:
-                self.handle_field(obj, field)
+            for name, accessor in self._accessors:
+                self.handle_field(obj, name, accessor)
             self.handle_model(obj)
             self.end_object(obj)
         self.end_serialization()
         return self.getvalue()
+
+    def serialize_iter(self, queryset, **options):
+        """
+        Serialize a queryset to iterable of JSON chunks, one per record.
+        Rows are read with ``queryset.iterator()``, so memory usage
+        doesn't depend on queryset size.
+        """
+        self.options = options
+        self.meta = options.get('meta', dict(root='records', total='total'))
+        self.extras = options.get('extras', [])
+        total = options.get('total')
+        if total is None:
+            total = queryset.count()
+        self.start_serialization(total)
+
+        self.colmodel = get_column_model(admin.site)
+        yield '{%s: %s, %s: [' % (simplejson.dumps(self.meta['total']),
+            simplejson.dumps(total), simplejson.dumps(self.meta['root']))
+        records = self.objects[self.meta['root']]
+        separator = ''
+        for obj in queryset.iterator():
+            self.start_object(obj)
+            for name, accessor in self._accessors:
+                self.handle_field(obj, name, accessor)
+            self.handle_model(obj)
+            self.end_object(obj)
+            # end_object collects records in self.objects, flush them
+            for record in records:
+                yield separator + simplejson.dumps(record, cls=DjangoJSONEncoder)
+                separator = ','
+            del records[:]
+        yield ']}'
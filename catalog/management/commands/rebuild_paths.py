@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from catalog.models import TreeItem
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+
+class Command(NoArgsCommand):
+    help = '''Recalculate stored ancestor paths for all catalog tree items.
+    Usage: manage.py rebuild_paths
+    '''
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        TreeItem.objects.rebuild_paths()
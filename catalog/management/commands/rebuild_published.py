@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from catalog.models import TreeItem
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+
+class Command(NoArgsCommand):
+    help = '''Recalculate published flag for all catalog tree items.
+    Run it after CATALOG_FILTERS setting changes
+    Usage: manage.py rebuild_published
+    '''
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        TreeItem.objects.rebuild_published()
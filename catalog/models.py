@@ -1,29 +1,156 @@
 # -*- coding: utf-8 -*-
 from catalog import settings as catalog_settings
-from catalog.utils import connected_models, get_q_filters
+from catalog.utils import connected_models, get_q_filters, registry
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models import Q, loading
-from django.db.models.signals import post_save
+from django.db.models import Q, F, loading
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from mptt.models import MPTTModel
+from threading import local
+
+
+def is_content_published(model_cls, object_id):
+    '''
+    Check content object against ``CATALOG_FILTERS``.
+    Objects of models not listed in ``CATALOG_MODELS`` (links, for example)
+    are never published.
+    '''
+    q_filters = get_q_filters()
+    if model_cls not in q_filters:
+        return False
+    model_filter = q_filters[model_cls]
+    if model_filter is None:
+        return True
+    return model_cls.objects.filter(model_filter).filter(pk=object_id).exists()
+
+def published_object_ids(model_cls, object_ids):
+    '''
+    Bulk version of :func:`is_content_published`,
+    returns set of published ids from given list
+    '''
+    q_filters = get_q_filters()
+    if model_cls not in q_filters:
+        return set()
+    model_filter = q_filters[model_cls]
+    if model_filter is None:
+        return set(object_ids)
+    return set(model_cls.objects.filter(model_filter).filter(
+        pk__in=object_ids).values_list('pk', flat=True))
+
+
+def _attach_content_objects(instances):
+    '''
+    Fetch generic foreign key targets with one query per content type
+    and put them into ``content_object`` cache of given instances
+    '''
+    object_ids = {}
+    for instance in instances:
+        object_ids.setdefault(instance.content_type_id, set()).add(instance.object_id)
+
+    objects = {}
+    for content_type_id, ids in object_ids.iteritems():
+        model_cls = ContentType.objects.get_for_id(content_type_id).model_class()
+        objects[content_type_id] = model_cls._default_manager.in_bulk(list(ids))
+
+    content_objects = []
+    for instance in instances:
+        content_object = objects[instance.content_type_id].get(instance.object_id)
+        # see GenericForeignKey.cache_attr
+        setattr(instance, '_content_object_cache', content_object)
+        if content_object is not None:
+            content_objects.append(content_object)
+    return content_objects
+
+def prefetch_content_objects(treeitems):
+    '''
+    Load content objects for list of tree items in a fixed number of queries.
+    Link targets are resolved in second pass.
+    '''
+    content_objects = _attach_content_objects(treeitems)
+    links = [obj for obj in content_objects if isinstance(obj, Link)]
+    if links:
+        _attach_content_objects(links)
+    return treeitems
+
+
+# number of rows prefetched at once by TreeItemQuerySet.iterator()
+PREFETCH_CHUNK_SIZE = 500
+
+
+class TreeItemQuerySet(models.query.QuerySet):
+
+    _prefetch_content = False
+
+    def with_content_objects(self):
+        '''
+        Load content objects for all rows in batch when queryset evaluates
+        '''
+        clone = self._clone()
+        clone._prefetch_content = True
+        return clone
+
+    def _clone(self, *args, **kwds):
+        clone = super(TreeItemQuerySet, self)._clone(*args, **kwds)
+        clone._prefetch_content = self._prefetch_content
+        return clone
+
+    def iterator(self):
+        if not self._prefetch_content:
+            for obj in super(TreeItemQuerySet, self).iterator():
+                yield obj
+        else:
+            # prefetch by chunks to keep memory bounded on large querysets
+            treeitems = []
+            for obj in super(TreeItemQuerySet, self).iterator():
+                treeitems.append(obj)
+                if len(treeitems) == PREFETCH_CHUNK_SIZE:
+                    for treeitem in prefetch_content_objects(treeitems):
+                        yield treeitem
+                    treeitems = []
+            for treeitem in prefetch_content_objects(treeitems):
+                yield treeitem
 
 
 class TreeItemManager(models.Manager):
 
+    def get_query_set(self):
+        return TreeItemQuerySet(self.model, using=self._db)
+
+    def with_content_objects(self):
+        return self.get_query_set().with_content_objects()
+
     def published(self):
-        tree_q = Q()
+        return self.get_query_set().filter(is_published=True)
 
+    def rebuild_published(self):
+        '''
+        Recalculate ``is_published`` flag for all tree items.
+        Use it after ``CATALOG_FILTERS`` setting has been changed.
+        '''
+        self.get_query_set().update(is_published=False)
         for model_cls, model_filter in get_q_filters().iteritems():
             ct = ContentType.objects.get_for_model(model_cls)
+            queryset = self.get_query_set().filter(content_type=ct)
             if model_filter is not None:
-                object_ids = model_cls.objects.filter(model_filter).values_list('id', flat=True)
-                tree_q |= Q(object_id__in=object_ids, content_type=ct)
-            else:
-                tree_q |= Q(content_type=ct)
+                object_ids = model_cls.objects.filter(model_filter).values('id')
+                queryset = queryset.filter(object_id__in=object_ids)
+            queryset.update(is_published=True)
+        bump_tree_version()
 
-        return self.get_query_set().filter(tree_q)
+    def rebuild_paths(self):
+        '''
+        Recalculate ``path`` column for all tree items,
+        one update query per non-leaf node.
+        '''
+        paths = {None: ''}
+        rows = self.get_query_set().order_by('tree_id', 'lft').values_list('id', 'parent')
+        for node_id, parent_id in rows.iterator():
+            paths[node_id] = '%s%s/' % (paths[parent_id], node_id)
+        parent_ids = self.get_query_set().order_by().values_list('parent', flat=True).distinct()
+        for parent_id in parent_ids:
+            self.get_query_set().filter(parent=parent_id).update(path=paths[parent_id])
 
 class TreeItem(MPTTModel):
     '''
@@ -44,14 +171,79 @@ class TreeItem(MPTTModel):
     object_id = models.PositiveIntegerField()
     content_object = generic.GenericForeignKey('content_type', 'object_id')
 
+    # denormalized result of CATALOG_FILTERS check, see :meth:`update_published`
+    is_published = models.BooleanField(default=True, db_index=True, editable=False)
+    # ancestor ids from root, like '1/38/', empty for root nodes.
+    # None means path was not calculated yet, see :meth:`TreeItemManager.rebuild_paths`
+    path = models.CharField(max_length=255, null=True, blank=True,
+        db_index=True, editable=False)
+
     objects = TreeItemManager()
 
     def __unicode__(self):
         return unicode(self.content_object)
 
+    def save(self, *args, **kwds):
+        old_path = None
+        if self.pk is None:
+            self.is_published = is_content_published(
+                registry.content_type_ids.get(self.content_type_id), self.object_id)
+            self.path = self._parent_path(self.parent)
+        else:
+            # parent changed by form or code, mptt moves node while saving
+            rows = TreeItem.objects.filter(id=self.pk).values_list('parent', 'path')
+            if rows and rows[0][0] != self.parent_id:
+                old_path = rows[0][1]
+        super(TreeItem, self).save(*args, **kwds)
+        # mptt 0.4 moves node with move_to, which updates paths itself,
+        # older versions move it directly
+        if old_path is not None and self.path == old_path:
+            self._move_paths(old_path)
+
     def get_absolute_url(self):
         return self.content_object.get_absolute_url()
 
+    def _parent_path(self, parent):
+        '''Path for children of given parent node'''
+        if parent is None:
+            return ''
+        if parent.path is None:
+            ancestor_ids = [ancestor.id for ancestor in parent.get_ancestors()]
+        else:
+            ancestor_ids = parent.get_ancestor_ids()
+        return ''.join(['%s/' % node_id for node_id in ancestor_ids + [parent.id]])
+
+    def get_ancestor_ids(self):
+        '''
+        Ancestor ids from root, read from stored path.
+        Returns None if path was not calculated
+        '''
+        if self.path is None:
+            return None
+        return [int(node_id) for node_id in self.path.split('/') if node_id]
+
+    def _move_paths(self, old_path):
+        '''Update stored paths of moved node and its subtree, one query per path'''
+        parent = self.parent_id and TreeItem.objects.get(id=self.parent_id) or None
+        self.path = self._parent_path(parent)
+        old_prefix = '%s%s/' % (old_path, self.id)
+        new_prefix = '%s%s/' % (self.path, self.id)
+        subtree_paths = TreeItem.objects.filter(path__startswith=old_prefix
+            ).order_by().values_list('path', flat=True).distinct()
+        for path in list(subtree_paths):
+            TreeItem.objects.filter(path=path).update(
+                path=new_prefix + path[len(old_prefix):])
+        TreeItem.objects.filter(id=self.id).update(path=self.path)
+
+    def move_to(self, target, position='first-child'):
+        old_path = self.path
+        super(TreeItem, self).move_to(target, position)
+        if old_path is not None:
+            self._move_paths(old_path)
+        # mptt moves nodes with raw updates, no signals are sent
+        bump_tree_version()
+    move_to.alters_data = True
+
     def delete(self, *args, **kwds):
         self.content_object.delete()
         super(TreeItem, self).delete(*args, **kwds)
@@ -78,11 +270,58 @@ class Link(models.Model):
         return _('Link to %s') % unicode(self.content_object)
 
 
+class TreeVersion(models.Model):
+    '''
+    Single row counter, incremented on every catalog tree modification.
+    Used to invalidate in-process tree snapshots, see :mod:`catalog.snapshot`
+    '''
+
+    class Meta:
+        verbose_name = _('Catalog tree version')
+        verbose_name_plural = _('Catalog tree versions')
+
+    version = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return unicode(self.version)
+
+
+def get_tree_version():
+    versions = TreeVersion.objects.filter(pk=1).values_list('version', flat=True)
+    if versions:
+        return versions[0]
+    return 0
+
+def bump_tree_version():
+    if not TreeVersion.objects.filter(pk=1).update(version=F('version') + 1):
+        TreeVersion.objects.create(pk=1, version=1)
+
+
+_sync_state = local()
+
+def suspend_tree_sync():
+    '''
+    Suspend published flag and tree version updates from signals in current
+    thread. Bulk operations use it and update state once when finished,
+    call :func:`resume_tree_sync` in ``finally`` block.
+    '''
+    _sync_state.suspended = getattr(_sync_state, 'suspended', 0) + 1
+
+def resume_tree_sync():
+    _sync_state.suspended = getattr(_sync_state, 'suspended', 1) - 1
+
+def tree_sync_suspended():
+    return getattr(_sync_state, 'suspended', 0) > 0
+
+
 def insert_in_tree(sender, instance, **kwrgs):
     '''
     Insert newly created object in catalog tree.
     If no parent provided, insert object in tree root 
     '''
+    # fixtures are loaded with their own tree items
+    if kwrgs.get('raw', False):
+        return
     # to avoid recursion save, process only for new instances
     created = kwrgs.pop('created', False)
 
@@ -95,8 +334,42 @@ def insert_in_tree(sender, instance, **kwrgs):
         tree_item.save()
         instance.save()
 
+def update_published(sender, instance, **kwrgs):
+    '''
+    Keep ``TreeItem.is_published`` in sync with content object state
+    '''
+    if kwrgs.get('created', False) or kwrgs.get('raw', False) or tree_sync_suspended():
+        # new tree item calculates flag itself, see :meth:`TreeItem.save`,
+        # fixtures contain flags of their tree items
+        return
+    ct = ContentType.objects.get_for_model(sender)
+    TreeItem.objects.filter(content_type=ct, object_id=instance.pk).update(
+        is_published=is_content_published(sender, instance.pk))
+    # object title could be changed too
+    bump_tree_version()
+
+def unpublish_deleted(sender, instance, **kwrgs):
+    '''
+    Hide tree items pointing to deleted object, if they still exist
+    '''
+    if tree_sync_suspended():
+        return
+    ct = ContentType.objects.get_for_model(sender)
+    TreeItem.objects.filter(content_type=ct, object_id=instance.pk).update(
+        is_published=False)
+    bump_tree_version()
+
+def tree_changed(sender, instance, **kwrgs):
+    if not tree_sync_suspended():
+        bump_tree_version()
+
+post_save.connect(tree_changed, TreeItem)
+post_delete.connect(tree_changed, TreeItem)
+
 for model_cls in connected_models():
     # set post_save signals on connected objects:
     # for each connected model connect 
     # automatic TreeItem creation for catalog models
     post_save.connect(insert_in_tree, model_cls)
+    post_save.connect(update_published, model_cls)
+    post_delete.connect(unpublish_deleted, model_cls)
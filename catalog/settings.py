@@ -10,6 +10,20 @@ CATALOG_MODELS = getattr(settings, 'CATALOG_MODELS', DEFAULT_CATALOG_MODELS)
 DEFAULT_MPTT = 'mptt' in settings.INSTALLED_APPS
 CATALOG_MPTT = getattr(settings, 'CATALOG_MPTT', DEFAULT_MPTT)
 
+# Engine for {% render_catalog_tree %} tag:
+# 'recursive' renders ``catalog/tree.html`` for every tree level,
+# 'flat' fetches visible nodes with one query and renders ``catalog/tree_node.html``
+# for every node without recursion
+CATALOG_TREE_ENGINE = getattr(settings, 'CATALOG_TREE_ENGINE', 'recursive')
+
+# Total count strategy for admin grid:
+# 'exact' runs COUNT(*) for every request,
+# 'cached' keeps counts per parent node in django cache until tree changes,
+# 'estimated' takes count from parent node lft/rght span (descendants count).
+# Can be a callable with (queryset, parent_id) arguments, returning
+# (total, is_estimated) tuple.
+CATALOG_GRID_COUNT = getattr(settings, 'CATALOG_GRID_COUNT', 'exact')
+
 # TODO: Extend existing SERIALIZATION_MODULES
 settings.SERIALIZATION_MODULES = {
     'catalog_extdirect' : 'catalog.grid_to_json',
@@ -27,3 +41,6 @@ settings.SERIALIZATION_MODULES = {
 #        'defauls.Section': dict(show=True),
 #        'defauls.Item': dict(hidden=False), 
 #    }
+#
+#Filters are denormalized into ``TreeItem.is_published`` flag, so run
+#``manage.py rebuild_published`` after changing this setting.
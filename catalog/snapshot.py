@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+In-process snapshot of whole catalog tree.
+
+Snapshot loads all ``TreeItem`` rows with one query and answers
+children, ancestors and descendants lookups from memory. It stays valid
+until :class:`~catalog.models.TreeVersion` counter changes, so every
+process rebuilds it only after tree modifications.
+'''
+from array import array
+from catalog.models import TreeItem, get_tree_version, prefetch_content_objects
+from django.contrib.contenttypes.models import ContentType
+from threading import Lock
+
+ROOT = 0
+# tree items or content objects fetched with one query
+BATCH_SIZE = 500
+
+_FIELDS = ('id', 'parent', 'tree_id', 'lft', 'rght', 'level',
+    'content_type', 'object_id', 'is_published')
+
+
+class TreeSnapshot(object):
+    '''
+    Compact in-memory copy of catalog tree.
+    Nodes are stored in parallel arrays ordered like ``TreeItem.Meta.ordering``,
+    so descendants of every node occupy continuous range right after it.
+    '''
+
+    def __init__(self, version):
+        self.version = version
+        self.ids = array('l')
+        self.parents = array('l')
+        self.tree_ids = array('l')
+        self.lfts = array('l')
+        self.rghts = array('l')
+        self.levels = array('l')
+        self.content_types = array('l')
+        self.object_ids = array('l')
+        self.published = array('b')
+        self.index = {}
+        self._children = {ROOT: []}
+        # {node_id: title}, filled on demand
+        self._titles = {}
+
+        rows = TreeItem.objects.order_by('tree_id', 'lft').values_list(*_FIELDS)
+        for pos, row in enumerate(rows.iterator()):
+            (node_id, parent_id, tree_id, lft, rght, level,
+                content_type_id, object_id, is_published) = row
+            parent_id = parent_id or ROOT
+            self.ids.append(node_id)
+            self.parents.append(parent_id)
+            self.tree_ids.append(tree_id)
+            self.lfts.append(lft)
+            self.rghts.append(rght)
+            self.levels.append(level)
+            self.content_types.append(content_type_id)
+            self.object_ids.append(object_id)
+            self.published.append(is_published)
+            self.index[node_id] = pos
+            self._children.setdefault(parent_id, []).append(pos)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, node_id):
+        return node_id in self.index
+
+    def _filter(self, positions, published):
+        if published:
+            return [self.ids[pos] for pos in positions if self.published[pos]]
+        return [self.ids[pos] for pos in positions]
+
+    def children(self, node_id=None, published=False):
+        '''List of children ids, root nodes if ``node_id`` is None'''
+        return self._filter(self._children.get(node_id or ROOT, []), published)
+
+    def parent(self, node_id):
+        '''Parent id, None for root nodes'''
+        return self.parents[self.index[node_id]] or None
+
+    def ancestors(self, node_id):
+        '''List of ancestor ids, starting from root node'''
+        ancestors = []
+        parent_id = self.parents[self.index[node_id]]
+        while parent_id != ROOT:
+            ancestors.append(parent_id)
+            parent_id = self.parents[self.index[parent_id]]
+        ancestors.reverse()
+        return ancestors
+
+    def descendants(self, node_id=None, published=False):
+        '''List of descendant ids in tree order, all nodes if ``node_id`` is None'''
+        if node_id is None:
+            return self._filter(xrange(len(self.ids)), published)
+        pos = self.index[node_id]
+        count = self.descendant_count(node_id)
+        return self._filter(xrange(pos + 1, pos + 1 + count), published)
+
+    def tree_order(self, node_ids):
+        '''Sort node ids like ``TreeItem.Meta.ordering``'''
+        return sorted(node_ids, key=self.index.__getitem__)
+
+    def descendant_count(self, node_id):
+        pos = self.index[node_id]
+        return (self.rghts[pos] - self.lfts[pos] - 1) / 2
+
+    def is_leaf_node(self, node_id):
+        pos = self.index[node_id]
+        return self.rghts[pos] - self.lfts[pos] == 1
+
+    def model_class(self, node_id):
+        content_type_id = self.content_types[self.index[node_id]]
+        return ContentType.objects.get_for_id(content_type_id).model_class()
+
+    def load_titles(self, node_ids):
+        '''
+        Fetch titles of given nodes, which are not cached yet,
+        with one query per content type and batch
+        '''
+        object_ids = {}
+        for node_id in node_ids:
+            if node_id in self._titles:
+                continue
+            pos = self.index[node_id]
+            object_ids.setdefault(self.content_types[pos], []).append(
+                (self.object_ids[pos], node_id))
+
+        for content_type_id, pairs in object_ids.iteritems():
+            model_cls = ContentType.objects.get_for_id(content_type_id).model_class()
+            for start in xrange(0, len(pairs), BATCH_SIZE):
+                batch = pairs[start:start + BATCH_SIZE]
+                objects = model_cls._default_manager.in_bulk(
+                    [object_id for object_id, node_id in batch])
+                for object_id, node_id in batch:
+                    obj = objects.get(object_id)
+                    self._titles[node_id] = obj is not None and unicode(obj) or u''
+
+    def title(self, node_id):
+        '''Content object's unicode representation'''
+        if node_id not in self._titles:
+            self.load_titles([node_id])
+        return self._titles[node_id]
+
+
+_snapshot = None
+_lock = Lock()
+
+def get_snapshot():
+    '''
+    Returns actual tree snapshot. Costs one query to check tree version,
+    and rebuilds snapshot when version changed.
+    '''
+    global _snapshot
+    version = get_tree_version()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+
+    _lock.acquire()
+    try:
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = TreeSnapshot(version)
+        return _snapshot
+    finally:
+        _lock.release()
+
+def get_treeitems(node_ids):
+    '''
+    Returns ``TreeItem`` list in order of given ids. Items are fetched
+    by primary keys in batches, their content objects are prefetched.
+    '''
+    treeitems = []
+    for start in xrange(0, len(node_ids), BATCH_SIZE):
+        batch = node_ids[start:start + BATCH_SIZE]
+        items = TreeItem.objects.in_bulk(batch)
+        treeitems.extend(prefetch_content_objects(
+            [items[node_id] for node_id in batch if node_id in items]))
+    return treeitems
+
+def get_ancestors(treeitem):
+    '''
+    Returns ``TreeItem`` ancestors list, starting from root.
+    Ancestors are read from stored path or looked up in snapshot and fetched
+    with one query by primary keys, their content objects are prefetched.
+    '''
+    ancestor_ids = treeitem.get_ancestor_ids()
+    if ancestor_ids is None:
+        snapshot = get_snapshot()
+        if treeitem.id not in snapshot:
+            # item was created after snapshot has been built in this transaction
+            return prefetch_content_objects(list(treeitem.get_ancestors()))
+        ancestor_ids = snapshot.ancestors(treeitem.id)
+    return get_treeitems(ancestor_ids)
+
+def reset_snapshot():
+    '''Drop cached snapshot, useful in tests'''
+    global _snapshot
+    _snapshot = None
@@ -411,7 +411,10 @@ app.build_layout = function(){
         ddGroup: 'dd',
         enableDD: true,
         loader: new Ext.tree.TreeLoader({
-            directFn: Catalog.treeitem.tree
+            directFn: Catalog.treeitem.tree,
+            paramsAsHash: true,
+            // prefetch two levels per request
+            baseParams: {depth: 2}
         }),
         tbar: app.treeBar,
         listeners: {
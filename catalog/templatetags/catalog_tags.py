@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+from catalog import settings as catalog_settings
 from catalog.models import TreeItem
+from catalog.snapshot import get_ancestors, get_snapshot, get_treeitems
 from catalog.utils import get_data_appnames
 from classytags.arguments import Argument, ChoiceArgument
 from classytags.core import Tag, Options
 from classytags.helpers import InclusionTag
 from django import template
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import loading
 from django.template import loader, TemplateSyntaxError
@@ -72,7 +75,8 @@ class CatalogChildren(Tag):
           
             {% catalog_children for my_section %}
         
-        2. Render children for ``my_section`` into ``children`` context variable. ::
+        2. Render children for ``my_section`` into ``children`` context variable
+           (list of published ``TreeItem`` instances). ::
     
             {% catalog_children for my_section as children %}
         
@@ -120,17 +124,21 @@ class CatalogChildren(Tag):
                 except AttributeError:
                     raise TemplateSyntaxError('Instance argument must have `tree` attribute')
 
-        children_qs = TreeItem.objects.published().filter(parent=treeitem)
+        # children are looked up in tree snapshot, fetched by primary keys
+        snapshot = get_snapshot()
+        children_ids = snapshot.children(treeitem is not None and treeitem.id or None, published=True)
+        children_qs = get_treeitems(children_ids)
         if children_type:
-            children_qs = children_qs.filter(content_type__model=children_type)
+            children_qs = [child for child in children_qs
+                if ContentType.objects.get_for_id(child.content_type_id).model == children_type]
 
         if varname:
             context[varname] = children_qs
             return ''
         else:
-            self.templates[0:0] = ['%s/children_tag.html' % app_name for app_name in get_data_appnames()]
+            templates = ['%s/children_tag.html' % app_name for app_name in get_data_appnames()]
             context['children_queryset'] = children_qs
-            return render_to_string(self.templates, context)
+            return render_to_string(templates + self.templates, context)
 
 register.tag(CatalogChildren)
 
@@ -145,7 +153,7 @@ class BreadcrumbTag(InclusionTag):
     def get_context(self, context, **kwargs):
         treeitem = get_treeitem_from_context(context, silent=False)
         if treeitem is not None:
-            ancestors = list(treeitem.get_ancestors())
+            ancestors = get_ancestors(treeitem)
             return {'breadcrumbs': ancestors + [treeitem, ] }
         else:
             return {}
@@ -187,6 +195,11 @@ class CatalogTree(Tag):
     **Template**
     
         {% render_catalog_tree %} use ``catalog/tree.html`` template to render menu
+
+        With ``CATALOG_TREE_ENGINE = 'flat'`` setting tag selects all visible
+        nodes in tree snapshot, fetches them by primary keys and renders
+        ``catalog/tree_node.html`` for every node, nested lists are built
+        without recursion.
     
     **Examples**
     
@@ -209,6 +222,7 @@ class CatalogTree(Tag):
     '''
     name = 'render_catalog_tree'
     template = 'catalog/tree.html'
+    node_template = 'catalog/tree_node.html'
 
     options = Options(
         'activate',
@@ -220,21 +234,22 @@ class CatalogTree(Tag):
     )
 
     def render_tag(self, context, active, tree_type, current):
-        context.push()
-        if current is not None:
-            children = current.children.published()
-        else:
-            children = TreeItem.objects.published().filter(parent=None)
-
         if active == 'none':
             active = None
         elif active == 'guess':
             # Try to resolve ``object`` from context
             active = get_treeitem_from_context(context)
 
+        if catalog_settings.CATALOG_TREE_ENGINE == 'flat':
+            return self.render_flat(context, active, tree_type, current)
+
+        context.push()
+        current_id = current is not None and current.id or None
+        children = get_treeitems(get_snapshot().children(current_id, published=True))
+
         if active is not None:
             context['breadcrumbs'] = [active]
-            context['breadcrumbs'].extend(active.get_ancestors())
+            context['breadcrumbs'].extend(get_ancestors(active))
 
         context['object_list'] = children
         context['type'] = tree_type
@@ -245,6 +260,66 @@ class CatalogTree(Tag):
         context.pop()
         return output
 
+    def get_visible_nodes(self, tree_type, current, breadcrumbs):
+        '''
+        Returns list of all nodes, which could be shown in menu,
+        ordered by ``tree_id`` and ``lft``. Nodes are selected in tree snapshot.
+        '''
+        snapshot = get_snapshot()
+        current_id = current is not None and current.id or None
+        if tree_type == TREE_TYPE_EXPANDED:
+            node_ids = snapshot.descendants(current_id, published=True)
+        elif tree_type == TREE_TYPE_DRILLDOWN:
+            node_ids = snapshot.children(current_id, published=True)
+            for treeitem in breadcrumbs:
+                if treeitem.id in snapshot and treeitem.id != current_id:
+                    node_ids.extend(snapshot.children(treeitem.id, published=True))
+            node_ids = snapshot.tree_order(set(node_ids))
+        else:
+            node_ids = snapshot.children(current_id, published=True)
+        return get_treeitems(node_ids)
+
+    def render_flat(self, context, active, tree_type, current):
+        '''
+        Single pass menu rendering. Nested lists are opened and closed
+        while walking nodes in tree order.
+        '''
+        breadcrumbs = []
+        if active is not None:
+            breadcrumbs = [active] + get_ancestors(active)
+        breadcrumb_ids = set([treeitem.id for treeitem in breadcrumbs])
+        current_id = current is not None and current.id or None
+
+        node_template = loader.get_template(self.node_template)
+        context.push()
+        context['breadcrumbs'] = breadcrumbs
+        context['type'] = tree_type
+        context['active'] = active
+        context['current'] = current
+
+        output = []
+        # stack of nodes with opened children list
+        stack = []
+        for treeitem in self.get_visible_nodes(tree_type, current, breadcrumbs):
+            if treeitem.parent_id != current_id and treeitem.parent_id not in stack:
+                # parent is hidden or collapsed
+                continue
+            while stack and stack[-1] != treeitem.parent_id:
+                stack.pop()
+                output.append(u'</ul>')
+
+            context['treeitem'] = treeitem
+            output.append(node_template.render(context))
+
+            if tree_type == TREE_TYPE_EXPANDED or (tree_type == TREE_TYPE_DRILLDOWN
+                and treeitem.id in breadcrumb_ids and not treeitem.is_leaf_node()):
+                stack.append(treeitem.id)
+                output.append(u'<ul>')
+
+        output.extend([u'</ul>'] * len(stack))
+        context.pop()
+        return u''.join(output)
+
 register.tag(CatalogTree)
 
 
@@ -1 +1,6 @@
-from catalog_testmaker import *
\ No newline at end of file
+from catalog_testmaker import *
+from snapshot import *
+from tree_tag import *
+from bulk import *
+from grid import *
+from admin_form import *
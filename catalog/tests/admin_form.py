@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from catalog.contrib.defaults.models import Section
+from django.contrib import admin
+from django.test import TestCase
+
+
+class FormRequest(object):
+    '''Request without parent parameter'''
+    REQUEST = {}
+
+
+class SlugFormTest(TestCase):
+
+    fixtures = ["../fixtures/catalog_test.json"]
+
+    def setUp(self):
+        admin.autodiscover()
+        self.form_cls = admin.site._registry[Section].get_form(FormRequest())
+        self.section = Section.objects.create(name=u'Slug test', slug=u'slug-test')
+
+    def test_blank_slug(self):
+        form = self.form_cls({'name': u'Slug test', 'slug': u''})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['slug'], u'slug-test-2')
+
+    def test_taken_slug(self):
+        form = self.form_cls({'name': u'Other', 'slug': u'slug-test'})
+        self.assertFalse(form.is_valid())
+        self.assertTrue('slug' in form.errors)
+
+    def test_own_slug(self):
+        form = self.form_cls({'name': u'Renamed', 'slug': u'slug-test'},
+            instance=self.section)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['slug'], u'slug-test')
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from catalog.bulk import delete_subtrees, move_subtrees, check_tree
+from catalog.contrib.defaults.models import Section, Item
+from catalog.models import TreeItem, is_content_published
+from catalog.snapshot import reset_snapshot
+from decimal import Decimal
+from django.core.management import call_command
+from django.test import TestCase
+import os
+import tempfile
+
+
+class BulkDeleteTest(TestCase):
+
+    fixtures = ["../fixtures/catalog_test.json"]
+
+    def setUp(self):
+        reset_snapshot()
+        # second tree
+        TreeItem.objects.get(id=2).move_to(None)
+
+    def test_overlapping_selection(self):
+        tree_ids = set(TreeItem.objects.filter(id__in=[1, 2]).values_list('tree_id', flat=True))
+        self.assertEqual(len(tree_ids), 2)
+        deleted = TreeItem.objects.filter(id__in=[38, 39, 40, 41, 3])
+        objects = [(treeitem.content_type.model_class(), treeitem.object_id)
+            for treeitem in deleted]
+
+        # 39 lies inside 38
+        count = delete_subtrees([39, 38, 3])
+        self.assertEqual(count, 5)
+        self.assertFalse(TreeItem.objects.filter(id__in=[38, 39, 40, 41, 3]).exists())
+        for model_cls, object_id in objects:
+            self.assertFalse(model_cls.objects.filter(pk=object_id).exists())
+        for tree_id in tree_ids:
+            self.assertTrue(check_tree(tree_id))
+        self.assertEqual(TreeItem.objects.get(id=2).rght, 4)
+
+
+class BulkMoveTest(TestCase):
+    '''
+    Moves with ``move_subtrees`` must give the same tree as
+    ``TreeItem.move_to`` called for every node
+    '''
+
+    fixtures = ["../fixtures/catalog_test.json"]
+
+    def setUp(self):
+        reset_snapshot()
+        # second tree
+        TreeItem.objects.get(id=2).move_to(None)
+        TreeItem.objects.rebuild_paths()
+
+    def positions(self):
+        rows = TreeItem.objects.values_list('id', 'lft', 'rght', 'level', 'tree_id', 'parent', 'path')
+        return dict([(row[0], row[1:]) for row in rows])
+
+    def restore(self, positions):
+        for node_id, (lft, rght, level, tree_id, parent_id, path) in positions.iteritems():
+            TreeItem.objects.filter(id=node_id).update(lft=lft, rght=rght,
+                level=level, tree_id=tree_id, parent=parent_id, path=path)
+
+    def assertMoved(self, source_ids, target_id, position):
+        before = self.positions()
+        move_subtrees(source_ids, target_id, position)
+        moved = self.positions()
+
+        self.restore(before)
+        for node_id in source_ids:
+            target = target_id is not None and TreeItem.objects.get(id=target_id) or None
+            TreeItem.objects.get(id=node_id).move_to(target, position)
+        expected = self.positions()
+
+        self.assertNotEqual(before, expected)
+        for node_id in sorted(expected.keys()):
+            self.assertEqual(moved[node_id], expected[node_id],
+                'Node %d: %r != %r' % (node_id, moved[node_id], expected[node_id]))
+        for tree_id in set([row[3] for row in moved.itervalues()]):
+            self.assertTrue(check_tree(tree_id))
+
+    def test_within_tree(self):
+        self.assertMoved([39, 35], 23, 'last-child')
+
+    def test_across_trees(self):
+        self.assertMoved([3, 24], 38, 'first-child')
+        self.assertMoved([40], 2, 'last-child')
+
+    def test_to_root(self):
+        self.assertMoved([34, 39], None, 'last-child')
+
+    def test_left(self):
+        self.assertMoved([39, 4], 35, 'left')
+
+    def test_right(self):
+        self.assertMoved([36], 41, 'right')
+
+    def test_not_calculated_path(self):
+        TreeItem.objects.filter(id=1).update(path=None)
+        self.assertMoved([39], 34, 'last-child')
+        self.assertEqual(TreeItem.objects.get(id=1).path, None)
+        self.assertEqual(TreeItem.objects.get(id=39).path, '1/34/')
+
+
+class BulkImportTest(TestCase):
+
+    fixtures = ["../fixtures/catalog_test.json"]
+
+    def setUp(self):
+        reset_snapshot()
+        fd, self.filename = tempfile.mkstemp(suffix='.csv')
+        f = os.fdopen(fd, 'wb')
+        f.write(u'\r\n'.join([
+            # new section and new item
+            u'1001;Новый раздел;Новый товар;10.50',
+            # new item in existing section
+            u'1002;Бай Му Дань ;Бай Му Дань №200;80',
+            # existing item
+            u'1;Белый Чай (Бай Ча) ;Шоу Мэй То Ча ;120',
+        ]).encode('utf-8') + '\r\n')
+        f.close()
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_bulk(self):
+        items_count = Item.objects.count()
+        call_command('importcsv', self.filename, bulk=True)
+
+        self.assertEqual(Item.objects.count(), items_count + 2)
+        self.assertEqual(Item.objects.get(article='1').price, Decimal('120'))
+        import_node = Section.objects.get(name=u'Импорт').tree.get()
+        self.assertTrue(check_tree(import_node.tree_id))
+
+        section_node = Section.objects.get(name=u'Новый раздел').tree.get()
+        self.assertEqual(section_node.parent_id, import_node.id)
+        new_nodes = [section_node,
+            Item.objects.get(article='1001').tree.get(),
+            Item.objects.get(article='1002').tree.get()]
+        self.assertEqual(new_nodes[1].parent_id, section_node.id)
+        self.assertEqual(new_nodes[2].parent_id,
+            Section.objects.get(name=u'Бай Му Дань ').tree.get().id)
+        for treeitem in new_nodes:
+            self.assertEqual(treeitem.is_published, is_content_published(
+                treeitem.content_type.model_class(), treeitem.object_id))
+            self.assertEqual(treeitem.path, ''.join(['%s/' % ancestor.id
+                for ancestor in treeitem.get_ancestors()]))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from catalog import settings as catalog_settings
+from catalog.contrib.defaults.models import Section
+from catalog.direct import objects
+from catalog.models import TreeItem
+from catalog.snapshot import reset_snapshot
+from catalog.utils import registry
+from django.conf import settings
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import TestCase
+
+
+class DirectRequest(object):
+    '''Request with data of ExtDirect call'''
+
+    def __init__(self, **data):
+        self.extdirect_post_data = [data]
+
+
+class GridCursorTest(TestCase):
+
+    fixtures = ["../fixtures/catalog_test.json"]
+
+    def setUp(self):
+        reset_snapshot()
+        admin.autodiscover()
+        self.children = list(TreeItem.objects.filter(parent=1).order_by(
+            'tree_id', 'lft').values_list('id', flat=True))
+
+    def page(self, cursor):
+        res = objects(DirectRequest(parent=1, cursor=cursor, limit=3))
+        return [int(record['id']) for record in res['records']], res
+
+    def test_first_page(self):
+        ids, res = self.page('')
+        self.assertEqual(ids, self.children[:3])
+        self.assertEqual(res['total'], len(self.children))
+        self.assertEqual(res['prev'], None)
+        self.assertNotEqual(res['next'], None)
+
+    def test_paging(self):
+        pages = []
+        ids, res = self.page('')
+        while True:
+            pages.append(ids)
+            if res['next'] is None:
+                break
+            ids, res = self.page(res['next'])
+        self.assertEqual(sum(pages, []), self.children)
+        self.assertEqual(len(pages[-1]), len(self.children) % 3 or 3)
+
+        # back from the last page
+        back_pages = []
+        while res['prev'] is not None:
+            ids, res = self.page(res['prev'])
+            back_pages.append(ids)
+        back_pages.reverse()
+        self.assertEqual(back_pages, pages[:-1])
+        self.assertEqual(res['prev'], None)
+        self.assertNotEqual(res['next'], None)
+
+    def test_invalid_cursor(self):
+        ids, res = self.page('not a cursor')
+        self.assertEqual(ids, self.children[:3])
+
+
+class GridCountTest(TestCase):
+
+    fixtures = ["../fixtures/catalog_test.json"]
+
+    def setUp(self):
+        reset_snapshot()
+        admin.autodiscover()
+        cache.clear()
+        self.strategy = catalog_settings.CATALOG_GRID_COUNT
+        self.debug = settings.DEBUG
+
+    def tearDown(self):
+        catalog_settings.CATALOG_GRID_COUNT = self.strategy
+        settings.DEBUG = self.debug
+
+    def count_queries(self):
+        '''Returns total and COUNT queries of unpaginated grid request'''
+        # queries are logged in debug mode only
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            res = objects(DirectRequest(parent=1))
+        finally:
+            settings.DEBUG = self.debug
+        return res['total'], [query['sql'] for query in connection.queries
+            if 'COUNT(' in query['sql'].upper()]
+
+    def test_exact(self):
+        catalog_settings.CATALOG_GRID_COUNT = 'exact'
+        total, queries = self.count_queries()
+        self.assertEqual(total, TreeItem.objects.filter(parent=1).count())
+        self.assertEqual(len(queries), 1)
+
+    def test_cached(self):
+        catalog_settings.CATALOG_GRID_COUNT = 'cached'
+        self.count_queries()
+        total, queries = self.count_queries()
+        self.assertEqual(total, TreeItem.objects.filter(parent=1).count())
+        self.assertEqual(queries, [])
+
+    def test_estimated(self):
+        catalog_settings.CATALOG_GRID_COUNT = 'estimated'
+        total, queries = self.count_queries()
+        self.assertEqual(total, TreeItem.objects.get(id=1).get_descendant_count())
+        self.assertEqual(queries, [])
+
+
+class AdminClassTest(TestCase):
+
+    def setUp(self):
+        admin.autodiscover()
+        registry.reset_admin_classes()
+
+    def test_cached(self):
+        admin_cls = registry.get_admin_class(Section)
+        self.assertTrue(admin_cls is admin.site._registry[Section])
+        self.assertTrue(registry.get_admin_class(Section) is admin_cls)
+
+    def test_unregistered(self):
+        site = admin.AdminSite()
+        self.assertRaises(ImproperlyConfigured, registry.get_admin_class, Section, site)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from catalog.models import TreeItem
+from catalog.snapshot import get_snapshot, get_treeitems, reset_snapshot
+from django.test import TestCase
+
+
+class TreeSnapshotTest(TestCase):
+
+    fixtures = ["../fixtures/catalog_test.json"]
+
+    def setUp(self):
+        reset_snapshot()
+
+    def test_lookups(self):
+        snapshot = get_snapshot()
+        self.assertEqual(len(snapshot), TreeItem.objects.count())
+        self.assertEqual(snapshot.children(None),
+            list(TreeItem.objects.filter(parent=None).values_list('id', flat=True)))
+        self.assertEqual(snapshot.children(38),
+            list(TreeItem.objects.filter(parent=38).values_list('id', flat=True)))
+        self.assertEqual(snapshot.ancestors(39), [1, 38])
+        self.assertEqual(snapshot.descendants(1),
+            list(TreeItem.objects.get(id=1).get_descendants().values_list('id', flat=True)))
+        self.assertEqual(snapshot.descendants(None),
+            list(TreeItem.objects.order_by('tree_id', 'lft').values_list('id', flat=True)))
+        self.assertEqual(snapshot.parent(39), 38)
+        self.assertEqual(snapshot.parent(1), None)
+        self.assertEqual(snapshot.tree_order([39, 2, 38]), list(TreeItem.objects.filter(
+            id__in=[39, 2, 38]).order_by('tree_id', 'lft').values_list('id', flat=True)))
+        self.assertEqual([treeitem.id for treeitem in get_treeitems([39, 2, 38])], [39, 2, 38])
+
+    def test_invalidation(self):
+        snapshot = get_snapshot()
+        self.assertTrue(get_snapshot() is snapshot)
+        TreeItem.objects.get(id=39).move_to(TreeItem.objects.get(id=1), 'last-child')
+        new_snapshot = get_snapshot()
+        self.assertFalse(new_snapshot is snapshot)
+        self.assertEqual(new_snapshot.ancestors(39), [1])
+
+    def test_titles(self):
+        snapshot = get_snapshot()
+        snapshot.load_titles([38, 39])
+        self.assertEqual(sorted(snapshot._titles.keys()), [38, 39])
+        self.assertEqual(snapshot.title(39), unicode(TreeItem.objects.get(id=39).content_object))
+        self.assertEqual(snapshot.title(1), unicode(TreeItem.objects.get(id=1).content_object))
+
+    def test_parent_change(self):
+        TreeItem.objects.rebuild_paths()
+        section = TreeItem.objects.get(id=38)
+        section.parent = TreeItem.objects.get(id=34)
+        section.save()
+        self.assertEqual(TreeItem.objects.get(id=38).path, '1/34/')
+        self.assertEqual(TreeItem.objects.get(id=39).path, '1/34/38/')
+        self.assertEqual(get_snapshot().ancestors(39), [1, 34, 38])
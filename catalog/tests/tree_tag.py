@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from catalog import settings as catalog_settings
+from catalog.models import TreeItem
+from catalog.snapshot import reset_snapshot
+from django.template import Template, Context
+from django.test import TestCase
+import re
+
+
+class TreeEngineTest(TestCase):
+
+    fixtures = ["../fixtures/catalog_test.json"]
+
+    def setUp(self):
+        reset_snapshot()
+        self.engine = catalog_settings.CATALOG_TREE_ENGINE
+
+    def tearDown(self):
+        catalog_settings.CATALOG_TREE_ENGINE = self.engine
+
+    def render(self, engine, tree_type):
+        catalog_settings.CATALOG_TREE_ENGINE = engine
+        template = Template('{% load catalog_tags %}'
+            '{% render_catalog_tree activate active type tree_type %}')
+        output = template.render(Context({
+            'active': TreeItem.objects.get(id=39),
+            'tree_type': tree_type,
+        }))
+        return re.sub(r'>\s+<', '><', u' '.join(output.split()))
+
+    def test_same_markup(self):
+        for tree_type in ('expanded', 'collapsed', 'drilldown'):
+            recursive = self.render('recursive', tree_type)
+            flat = self.render('flat', tree_type)
+            self.assertTrue(recursive)
+            self.assertEqual(recursive, flat, 'Different markup in %s mode' % tree_type)
+
+    def test_children(self):
+        TreeItem.objects.filter(id=40).update(is_published=False)
+        template = Template('{% load catalog_tags %}'
+            '{% catalog_children for section as children %}'
+            '{% catalog_children for section type item as items %}'
+            '{% catalog_children for section type section as sections %}')
+        context = Context({'section': TreeItem.objects.get(id=38)})
+        template.render(context)
+        expected = list(TreeItem.objects.published().filter(parent=38))
+        self.assertEqual(context['children'], expected)
+        self.assertEqual(context['items'], [treeitem for treeitem in expected
+            if treeitem.content_type.model == 'item'])
+        self.assertEqual(context['sections'], [])
+        self.assertFalse(TreeItem.objects.get(id=40) in context['children'])
@@ -3,29 +3,143 @@ import warnings
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse
 from django.db.models import loading, Q
 
 from catalog import settings as catalog_settings
 
+try:
+    from pinyin.urlify import urlify
+except ImportError:
+    try:
+        from pytils.translit import slugify as urlify
+    except ImportError:
+        from django.template.defaultfilters import slugify as urlify
 
-def connected_models():
-    for model_str in catalog_settings.CATALOG_MODELS:
+
+class CatalogRegistry(object):
+    '''
+    Compiled ``CATALOG_MODELS`` and ``CATALOG_FILTERS`` settings.
+    Settings are parsed once on first access, use :meth:`reset`
+    if settings were changed (in tests, for example).
+    Admin classes are looked up once per site, use
+    :meth:`reset_admin_classes` if admin registration was changed.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._models = None
+        self._filters = None
+        self._by_module_name = None
+        self._app_labels = None
+        self._content_type_ids = None
+        self.reset_admin_classes()
+
+    def reset_admin_classes(self):
+        # {(id(site), model_cls): ModelAdmin instance}
+        self._admin_classes = {}
+
+    def _parse_model_str(self, model_str):
         if type(model_str) in (list, tuple):
-            applabel = model_str[0]
-            model_name = model_str[1]
             warnings.warn(
                 'CATALOG_MODELS setting should have new format, like: ("defaults.Item", "defaults.Section")',
                 DeprecationWarning
             )
-            model_cls = loading.cache.get_model(applabel, model_name)
+            return model_str[0], model_str[1]
         else:
-            model_cls = loading.cache.get_model(*model_str.split('.'))
+            return model_str.split('.')
+
+    def _load_models(self):
+        models = []
+        for model_str in catalog_settings.CATALOG_MODELS:
+            app_label, model_name = self._parse_model_str(model_str)
+            model_cls = loading.cache.get_model(app_label, model_name)
+            if model_cls is None:
+                raise ImproperlyConfigured('Can not import model %s from app %s,'
+                    ' check CATALOG_MODELS setting' % (model_name, app_label))
+            models.append(model_cls)
+        return models
+
+    def _load_filters(self):
+        q_filters = {}
+        for model_cls in self.models:
+            q_filters[model_cls] = None
 
-        if model_cls is None:
-            raise ImproperlyConfigured('Can not import model %s from app %s,'
-                     ' check CATALOG_MODELS setting' % (model_cls.__name__,
-                                                        model_cls._meta.app_label))
-        yield model_cls
+        CATALOG_FILTERS = getattr(settings, 'CATALOG_FILTERS', None)
+        if CATALOG_FILTERS is not None:
+            # Check if CATALOG_FILTERS has nested dictionaries
+            if any([isinstance(val, dict) for val in CATALOG_FILTERS.values()]):
+                # Apply filter per-model
+                for model_str, model_filter in CATALOG_FILTERS.iteritems():
+                    model_cls = loading.cache.get_model(*model_str.split('.'))
+                    q_filters[model_cls] = Q(**model_filter)
+            else:
+                # Apply filter to all models
+                for key in q_filters.iterkeys():
+                    q_filters[key] = Q(**CATALOG_FILTERS)
+        return q_filters
+
+    @property
+    def models(self):
+        '''List of connected model classes'''
+        if self._models is None:
+            self._models = self._load_models()
+        return self._models
+
+    @property
+    def filters(self):
+        '''Dictionary {model_cls: Q object or None}'''
+        if self._filters is None:
+            self._filters = self._load_filters()
+        return self._filters
+
+    @property
+    def app_labels(self):
+        '''Set of connected models application labels'''
+        if self._app_labels is None:
+            self._app_labels = set([self._parse_model_str(model_str)[0]
+                for model_str in catalog_settings.CATALOG_MODELS])
+        return self._app_labels
+
+    @property
+    def content_type_ids(self):
+        '''Dictionary {content_type_id: model_cls}'''
+        if self._content_type_ids is None:
+            # avoid loading contenttypes before models are ready
+            from django.contrib.contenttypes.models import ContentType
+            self._content_type_ids = dict([
+                (ContentType.objects.get_for_model(model_cls).id, model_cls)
+                for model_cls in self.models])
+        return self._content_type_ids
+
+    def get_model(self, module_name):
+        '''Returns connected model by its ``_meta.module_name`` or None'''
+        if self._by_module_name is None:
+            self._by_module_name = dict([(model_cls._meta.module_name, model_cls)
+                for model_cls in self.models])
+        return self._by_module_name.get(module_name)
+
+    def get_admin_class(self, model_cls, site=None):
+        '''Returns ModelAdmin instance, registered for connected model'''
+        if site is None:
+            from django.contrib import admin
+            site = admin.site
+        key = (id(site), model_cls)
+        if key not in self._admin_classes:
+            try:
+                self._admin_classes[key] = site._registry[model_cls]
+            except KeyError:
+                raise ImproperlyConfigured('Model %s is not registered in admin site,'
+                    ' make sure admin.autodiscover() is called in urlconf' % model_cls.__name__)
+        return self._admin_classes[key]
+
+registry = CatalogRegistry()
+
+
+def connected_models():
+    return iter(registry.models)
 
 
 def get_data_appnames():
@@ -33,18 +147,7 @@ def get_data_appnames():
     Returns app labales from connected models, for example:
     ['defaults',] or ['custom_catalog',] or ['defaults', 'custom_catalog']
     '''
-    app_labels = set()
-    for model_str in catalog_settings.CATALOG_MODELS:
-        if type(model_str) in (list, tuple):
-            app_label = model_str[0]
-            warnings.warn(
-                'CATALOG_MODELS setting should have new format, like: ("defaults.Item", "defaults.Section")',
-                PendingDeprecationWarning
-            )
-        else:
-            app_label, _ = model_str.split('.')
-        app_labels.update([app_label, ])
-    return app_labels
+    return registry.app_labels
 
 def get_q_filters():
     '''
@@ -52,21 +155,70 @@ def get_q_filters():
     {'app_label.model_name': model_query}
     where model_query is django ``Q`` object
     '''
-    q_filters = {}
-    for model_cls in connected_models():
-        q_filters[model_cls] = None
-
-    CATALOG_FILTERS = getattr(settings, 'CATALOG_FILTERS', None)
-    if getattr(settings, 'CATALOG_FILTERS', None) is not None:
-        # Check if CATALOG_FILTERS has nested dictionaries
-        if any([isinstance(val, dict) for val in CATALOG_FILTERS.values()]):
-            # Apply filter per-model
-            for model_str, model_filter in CATALOG_FILTERS.iteritems():
-                model_cls = loading.cache.get_model(*model_str.split('.'))
-                q_filters[model_cls] = Q(**model_filter)
+    return registry.filters
+
+
+class SlugAllocator(object):
+    '''
+    Assigns unique slugs to model objects without failed inserts.
+    With ``preload`` all existing slugs are read once, which suits bulk
+    loaders, otherwise slugs with the same prefix are read on every call.
+    Taken slugs get deterministic suffixes ``-2``, ``-3`` and so on.
+    '''
+
+    def __init__(self, model_cls, field_name='slug', preload=True):
+        self.model_cls = model_cls
+        self.field_name = field_name
+        self.max_length = model_cls._meta.get_field(field_name).max_length
+        self.default = model_cls._meta.module_name
+        self.taken = None
+        # {slug: last used suffix}, valid only with preloaded slugs
+        self.last_suffix = {}
+        if preload:
+            self.taken = set(model_cls._default_manager.values_list(field_name, flat=True))
+
+    def _load_taken(self, slug, exclude_pk):
+        # leave room for suffix, truncated slugs have the same prefix
+        prefix = slug[:self.max_length - 11]
+        queryset = self.model_cls._default_manager.filter(**{
+            '%s__startswith' % self.field_name: prefix})
+        if exclude_pk is not None:
+            queryset = queryset.exclude(pk=exclude_pk)
+        return set(queryset.values_list(self.field_name, flat=True))
+
+    def allocate(self, slug, exclude_pk=None):
+        '''
+        Returns unique slug based on given one. ``exclude_pk`` is primary key
+        of saved object, its own slug is not a collision (without preload only)
+        '''
+        slug = (slug or self.default)[:self.max_length]
+        if self.taken is None:
+            taken = self._load_taken(slug, exclude_pk)
+            suffix = 1
         else:
-            # Apply filter to all models
-            global_filter = CATALOG_FILTERS
-            for key in q_filters.iterkeys():
-                q_filters[key] = Q(**global_filter)
-    return q_filters
+            taken = self.taken
+            suffix = self.last_suffix.get(slug, 1)
+        unique_slug = slug
+        while unique_slug in taken:
+            suffix += 1
+            tail = u'-%d' % suffix
+            unique_slug = slug[:self.max_length - len(tail)] + tail
+        if self.taken is not None:
+            self.last_suffix[slug] = suffix
+            self.taken.add(unique_slug)
+        return unique_slug
+
+
+ID_PLACEHOLDER = '1234567890'
+
+def url_template(viewname, placeholder='%s', args=None, kwargs=None):
+    '''
+    Reverses url with ``ID_PLACEHOLDER`` in ``args`` or ``kwargs`` once
+    and returns format string with ``placeholder`` instead of it, e.g.
+    ``url_template('admin:defaults_item_change', args=[ID_PLACEHOLDER])``
+    gives ``'/admin/defaults/item/%s/'``
+    '''
+    url = reverse(viewname, args=args, kwargs=kwargs)
+    # other percent signs in url must survive formatting
+    head, tail = url.replace('%', '%%').rsplit(ID_PLACEHOLDER, 1)
+    return head + placeholder + tail
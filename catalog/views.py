@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from catalog.models import TreeItem
-from catalog.utils import connected_models, get_data_appnames, get_q_filters
+from catalog.utils import registry, get_data_appnames, get_q_filters
 from django.utils.translation import ugettext_lazy as _
 from django.http import Http404
 from django.template import loader
@@ -61,10 +61,7 @@ def item_view(request, model, slug=None, object_id=None):
             A list of the page numbers (1-indexed).
     
     '''
-    ModelClass = None
-    for model_cls in connected_models():
-        if model_cls._meta.module_name == model:
-            ModelClass = model_cls
+    ModelClass = registry.get_model(model)
 
     if ModelClass is not None:
         model_filter = get_q_filters()[ModelClass] 
@@ -146,4 +143,4 @@ def root(request):
         'template_name': t.name,
     }
 
-    return object_list(request, TreeItem.objects.published().filter(parent=None), **extra_context)
+    return object_list(request, TreeItem.objects.published().filter(parent=None).with_content_objects(), **extra_context)